@@ -0,0 +1,403 @@
+"""
+asyncio support, Python 3 only.
+
+AsyncSender provides awaitable call and send on an AsyncioConnection.
+AsyncServiceBus receives messages on the asyncio event loop and dispatches
+them to services. Service's on_call and on_message can be coroutine
+functions, plain functions are run in the loop's default executor. At
+most prefetch count of deliveries are handled at the same time.
+"""
+import copy
+import uuid
+import asyncio
+import inspect
+import logging
+from servicebus import pika
+from servicebus.pika.adapters.asyncio_connection import AsyncioConnection
+from servicebus.message import TimeoutException, Envelope, DIRECT_REPLY_TO_QUEUE
+from servicebus.message import deadline_properties, get_deadline, is_expired, decode_body, decompress_body
+from servicebus.sender import parse_target
+from servicebus.request import Request
+from servicebus.dispatch import EventDispatcher
+from servicebus.parser import XmlResponseParser
+from servicebus.parser import XmlMessageParser, XmlResponseGenerator
+
+
+class AsyncConnection(object):
+    """
+    Coroutine wrapper of one AsyncioConnection and its channel.
+    """
+    def __init__(self, configuration, host, loop):
+        self.configuration = configuration
+        self.host = host
+        self.loop = loop
+        self.connection = None
+        self.channel = None
+        self.closed = loop.create_future()
+
+    async def open(self):
+        opened = self.loop.create_future()
+
+        def on_open(connection):
+            connection.channel(on_open_callback=on_channel_open)
+
+        def on_channel_open(channel):
+            if not opened.done():
+                opened.set_result(channel)
+
+        def on_open_error(connection, error=None):
+            if not opened.done():
+                opened.set_exception(Exception("Cannot connect to %s: %s" % (self.host, error)))
+
+        def on_close(connection, reply_code, reply_text):
+            self.channel = None
+            if not opened.done():
+                opened.set_exception(Exception("Connection to %s closed: %s" % (self.host, reply_text)))
+            if not self.closed.done():
+                self.closed.set_result((reply_code, reply_text))
+
+        configuration = self.configuration
+        self.connection = AsyncioConnection(
+            pika.ConnectionParameters(
+                self.host,
+                configuration.get_port(),
+                credentials=pika.PlainCredentials(configuration.user, configuration.password),
+                ssl=configuration.use_ssl,
+                heartbeat_interval=configuration.heartbeat_interval,
+                socket_timeout=configuration.socket_timeout
+            ),
+            on_open,
+            on_open_error,
+            on_close,
+            custom_ioloop=self.loop
+        )
+        self.channel = await opened
+        return self.channel
+
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    async def rpc(self, method, **kwargs):
+        # Call a channel method which takes a callback as first argument
+        # and wait for the reply frame.
+        future = self.loop.create_future()
+
+        def callback(frame):
+            if not future.done():
+                future.set_result(frame)
+
+        method(callback, **kwargs)
+        await asyncio.wait([future, self.closed], return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            raise Exception("Connection to %s closed" % self.host)
+        return future.result()
+
+    async def close(self):
+        if self.connection is None or self.closed.done():
+            return
+        try:
+            self.connection.close()
+        except Exception as e:
+            logging.exception(e)
+            return
+        await asyncio.wait([self.closed], timeout=self.configuration.socket_timeout)
+
+
+def encode_request(configuration, category, service, params, timeout, **kwargs):
+    # Return body and properties of a request in configuration's codec.
+    codec = configuration.message_codec
+    msg = codec.encode(configuration, category, service, params)
+    kwargs['content_type'] = codec.content_type
+    if isinstance(msg, Envelope):
+        kwargs.update(msg.properties)
+        msg = msg.body
+    return msg, deadline_properties(timeout, **kwargs)
+
+
+class AsyncSender(object):
+    """
+    asyncio version of Sender. All calls share one connection and receive
+    responses by RabbitMQ direct reply-to.
+    """
+    def __init__(self, configuration, loop=None):
+        self.configuration = configuration
+        self.exchange_name = configuration.exchange_name
+        self.loop = loop or asyncio.get_event_loop()
+        self.connection = None
+        self.pending = {}
+        self.connect_lock = asyncio.Lock()
+
+    async def ensure_connection(self):
+        async with self.connect_lock:
+            if self.connection is not None and self.connection.is_open():
+                return self.connection
+            for host in self.configuration.hosts:
+                connection = AsyncConnection(self.configuration, host, self.loop)
+                try:
+                    channel = await connection.open()
+                    await connection.rpc(channel.exchange_declare, exchange=self.exchange_name,
+                                         exchange_type='direct')
+                    channel.basic_consume(self.on_response, queue=DIRECT_REPLY_TO_QUEUE, no_ack=True)
+                except Exception as e:
+                    logging.exception(e)
+                    await connection.close()
+                    continue
+                connection.closed.add_done_callback(self.on_connection_closed)
+                self.connection = connection
+                return connection
+            raise Exception("Cannot Connect to Message Queue!")
+
+    def on_connection_closed(self, closed):
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(Exception("Connection closed"))
+
+    def on_response(self, channel, method, props, body):
+        future = self.pending.pop(props.correlation_id, None)
+        if future is not None and not future.done():
+            future.set_result(decode_body(body, props))
+
+    async def call(self, target, params, timeout=300):
+        target, category, service = parse_target(target)
+        connection = await self.ensure_connection()
+        corr_id = str(uuid.uuid4())
+        body, properties = encode_request(
+            self.configuration, category, service, params, timeout,
+            reply_to=DIRECT_REPLY_TO_QUEUE,
+            correlation_id=corr_id,
+        )
+        future = self.loop.create_future()
+        self.pending[corr_id] = future
+        try:
+            connection.channel.basic_publish(
+                exchange=self.exchange_name,
+                routing_key=str(target),
+                properties=properties,
+                body=body)
+            ret = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException("Timeout")
+        finally:
+            self.pending.pop(corr_id, None)
+        resp_parser = XmlResponseParser()
+        return resp_parser.parse(ret)
+
+    async def send(self, target, params, ttl=None):
+        target, category, service = parse_target(target)
+        connection = await self.ensure_connection()
+        body, properties = encode_request(self.configuration, category, service, params, ttl)
+        connection.channel.basic_publish(exchange=self.exchange_name, routing_key=str(target),
+                                         properties=properties, body=body)
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+
+class AsyncRequest(Request):
+    def __init__(self, event, service_bus):
+        super(AsyncRequest, self).__init__(event, None)
+        self.service_bus = service_bus
+
+    def get_sender(self):
+        # AsyncSender is shared by all requests and closed by service bus.
+        return self.service_bus.get_sender()
+
+
+class AsyncRPCResponse(object):
+    def __init__(self, event, header, receiver):
+        self.event = event
+        self.header = header
+        self.receiver = receiver
+
+    def send(self, message):
+        msg = XmlResponseGenerator(self.event.id, message)
+        # Plain services run in executor threads, so always publish on
+        # the event loop's thread.
+        self.receiver.loop.call_soon_threadsafe(self.receiver.response_message, self.header, msg.to_xml())
+
+
+class AsyncMessageBusReceiver(EventDispatcher):
+    def __init__(self, service_bus, host):
+        self.service_bus = service_bus
+        self.host = host
+        self.loop = service_bus.loop
+        self.connection = AsyncConnection(service_bus.configuration, host, self.loop)
+        self.message_parser = XmlMessageParser()
+        self.message_parser.set_configuration(service_bus.configuration)
+        # Service tasks dispatched by the delivery being handled
+        self.tasks = []
+
+    async def start_receive(self):
+        configuration = self.service_bus.configuration
+        queue_name = configuration.queue_name()
+        exchange_name = configuration.exchange_name
+        channel = await self.connection.open()
+        await self.connection.rpc(channel.exchange_declare, exchange=exchange_name, exchange_type='direct')
+        await self.connection.rpc(channel.queue_declare, queue=queue_name, durable=True)
+        await self.connection.rpc(channel.queue_bind, queue=queue_name, exchange=exchange_name,
+                                  routing_key=queue_name)
+        await self.connection.rpc(channel.basic_qos, prefetch_count=self.service_bus.get_prefetch_count())
+        channel.basic_consume(self.on_receive, queue=queue_name)
+        await self.connection.closed
+
+    async def close(self):
+        await self.connection.close()
+
+    def response_message(self, header, message):
+        channel = self.connection.channel
+        if channel is None or not channel.is_open:
+            logging.error("Channel closed, drop response of %s" % header.correlation_id)
+            return
+        channel.basic_publish(exchange='',
+                              routing_key=header.reply_to,
+                              properties=pika.BasicProperties(correlation_id=header.correlation_id),
+                              body=message.encode())
+
+    def on_receive(self, channel, method, header, body):
+        self.service_bus.spawn(self.receive(channel, method, header, body))
+
+    async def receive(self, channel, method, header, body):
+        # A delivery is acked once it gets a slot and holds it until its
+        # services finish. Deliveries waiting for a slot stay unacked, so
+        # broker stops pushing more after prefetch count of them.
+        async with self.service_bus.slots:
+            self.tasks = []
+            self.handle_delivery(channel, method, header, body)
+            tasks, self.tasks = self.tasks, []
+            if tasks:
+                await asyncio.wait(tasks)
+
+    def handle_delivery(self, channel, method, header, body):
+        try:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            if is_expired(get_deadline(header)):
+                logging.warning("Drop expired message")
+                return
+            ebody = decompress_body(body, header)
+            if hasattr(header, 'reply_to') and header.reply_to is not None:
+                if ebody == b"PING":
+                    self.response_message(header, "PONG")
+                else:
+                    self.on_rpc(header, ebody)
+            else:
+                self.on_message(header, ebody)
+        except Exception as e:
+            logging.exception(e)
+
+    def on_rpc(self, header, body):
+        self.dispatch_rpc(header, body)
+
+    def on_message(self, header, body):
+        self.dispatch_message(header, body)
+
+    def lookup_rpc_service(self, category, name):
+        return self.service_bus.lookup_rpc_service(category, name)
+
+    def lookup_message_service(self, category, name):
+        return self.service_bus.lookup_message_service(category, name)
+
+    def call_rpc_service(self, service, event, header):
+        request = AsyncRequest(event, self.service_bus)
+        response = AsyncRPCResponse(event, header, self)
+        self.tasks.append(self.service_bus.dispatch(copy.copy(service).on_call, request, response))
+
+    def call_message_service(self, service, event, header):
+        request = AsyncRequest(event, self.service_bus)
+        self.tasks.append(self.service_bus.dispatch(copy.copy(service).on_message, request))
+
+
+class AsyncServiceBus(object):
+    """
+    asyncio version of ServiceBus. Instead of forking one process per
+    RabbitMQ host, it runs one receiver task per host on the event loop.
+    """
+    def __init__(self, configuration, loop=None):
+        self.configuration = configuration
+        self.loop = loop or asyncio.get_event_loop()
+        self.rpc_services = {}
+        self.message_services = {}
+        self.receivers = {}
+        self.sender = None
+        self.running = False
+        # asyncio keeps weak references of tasks only
+        self.tasks = set()
+        # Deliveries being handled by all receivers, see
+        # AsyncMessageBusReceiver.receive
+        self.slots = None
+
+    def add_rpc_service(self, category, name, service):
+        key = "%s.%s" % (category, name)
+        self.rpc_services[key] = service
+
+    def add_message_services(self, category, name, service):
+        key = "%s.%s" % (category, name)
+        self.message_services[key] = service
+
+    def lookup_rpc_service(self, category, name):
+        key = "%s.%s" % (category, name)
+        return self.rpc_services.get(key, None)
+
+    def lookup_message_service(self, category, name):
+        key = "%s.%s" % (category, name)
+        return self.message_services.get(key, None)
+
+    def get_sender(self):
+        if self.sender is None:
+            self.sender = AsyncSender(self.configuration, self.loop)
+        return self.sender
+
+    def get_prefetch_count(self):
+        services = list(self.rpc_services.values()) + list(self.message_services.values())
+        return self.configuration.get_prefetch_count(services)
+
+    def dispatch(self, func, *args):
+        return self.spawn(self.run_service(func, *args))
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run_service(self, func, *args):
+        try:
+            if inspect.iscoroutinefunction(func):
+                await func(*args)
+            else:
+                await self.loop.run_in_executor(None, func, *args)
+        except Exception as e:
+            logging.exception(e)
+
+    async def run_services(self):
+        self.running = True
+        self.slots = asyncio.Semaphore(self.get_prefetch_count())
+        await asyncio.gather(*[self.run_server(host) for host in self.configuration.hosts])
+
+    async def run_server(self, host):
+        while self.running:
+            receiver = AsyncMessageBusReceiver(self, host)
+            self.receivers[host] = receiver
+            try:
+                logging.info('[Server %s]: Start Receive' % host)
+                await receiver.start_receive()
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                await receiver.close()
+                self.receivers.pop(host, None)
+
+            if self.running:
+                logging.info('[Server %s]: Connection lost, wait 10 second to retry' % host)
+                await asyncio.sleep(10)
+        logging.info("[Server %s]: Shutdown" % host)
+
+    async def stop(self):
+        self.running = False
+        for receiver in list(self.receivers.values()):
+            await receiver.close()
+        if self.sender is not None:
+            await self.sender.close()
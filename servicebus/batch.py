@@ -0,0 +1,157 @@
+import os
+import time
+import struct
+import atexit
+import logging
+import threading
+from threading import Thread
+from servicebus.message import Envelope
+
+
+BATCH_CONTENT_TYPE = 'application/x-servicebus+batch'
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_BYTES = 128 * 1024
+BATCH_LENGTH = struct.Struct('>I')
+
+
+# Batch message format: for each event, 4 bytes big endian length and the
+# event in binary message format.
+def encode_batch(messages):
+    parts = []
+    for msg in messages:
+        parts.append(BATCH_LENGTH.pack(len(msg)))
+        parts.append(msg)
+    return b''.join(parts)
+
+
+def decode_batch(body):
+    # Generator of memoryview of each event in batch message body.
+    body = memoryview(body)
+    offset = 0
+    while offset < len(body):
+        length = BATCH_LENGTH.unpack_from(body, offset)[0]
+        offset += BATCH_LENGTH.size
+        if offset + length > len(body):
+            raise Exception("Batch message is truncated")
+        yield body[offset:offset + length]
+        offset += length
+
+
+class Batcher(object):
+    """
+    Accumulate events sent to same node into one batch message.
+
+    A batch is published when it has max_size events or max_bytes bytes, or
+    linger seconds after its first event was added. Batches are published by
+    a background thread with its own connection. Batches not published are
+    spooled if spool is enabled, otherwise dropped and logged.
+    """
+    def __init__(self, configuration, linger, max_size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_BATCH_BYTES):
+        self.configuration = configuration
+        self.linger = linger
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        # node -> [first add time, bytes, messages]
+        self.batches = {}
+        # Full batches waiting to be published, as (node, messages)
+        self.full = []
+        self.thread = None
+        self.caller = None
+        self.running = True
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+    def add(self, target, msg):
+        with self.condition:
+            self.check_fork()
+            if not self.running:
+                raise Exception("Batcher closed")
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            if target not in self.batches:
+                self.batches[target] = [time.time(), 0, []]
+                # Let background thread wait for linger of this batch.
+                self.condition.notify()
+            batch = self.batches[target]
+            batch[1] += len(msg)
+            batch[2].append(msg)
+            if len(batch[2]) >= self.max_size or batch[1] >= self.max_bytes:
+                del self.batches[target]
+                self.full.append((target, batch[2]))
+                self.condition.notify()
+
+    def check_fork(self):
+        # Batches and thread of parent process are not ours.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.batches = {}
+            self.full = []
+            self.thread = None
+            self.caller = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                ready = self.take_ready()
+                while self.running and len(ready) == 0:
+                    self.condition.wait(self.next_wait())
+                    ready = self.take_ready()
+                running = self.running
+            for target, messages in ready:
+                self.publish(target, messages)
+            if not running:
+                break
+        self.release_caller()
+
+    def take_ready(self):
+        now = time.time()
+        ready = self.full
+        self.full = []
+        for target, (first, size, messages) in list(self.batches.items()):
+            if not self.running or now - first >= self.linger:
+                del self.batches[target]
+                ready.append((target, messages))
+        return ready
+
+    def next_wait(self):
+        if len(self.batches) == 0:
+            return None
+        first = min(batch[0] for batch in self.batches.values())
+        return max(0, first + self.linger - time.time())
+
+    def publish(self, target, messages):
+        msg = Envelope(encode_batch(messages), content_type=BATCH_CONTENT_TYPE)
+        try:
+            if self.caller is None:
+                self.caller = self.configuration.create_sender()
+                self.caller.set_keep_alive(True)
+                self.caller.set_exchange(self.configuration.exchange_name)
+            self.caller.send(target, msg)
+        except Exception as e:
+            logging.exception(e)
+            self.release_caller()
+            if self.configuration.spool is not None:
+                self.configuration.spool_message(target, msg)
+            else:
+                logging.error("Drop batch of %d events to %s" % (len(messages), target))
+
+    def release_caller(self):
+        if self.caller is not None:
+            try:
+                self.configuration.release_sender(self.caller)
+            except Exception:
+                pass
+            self.caller = None
+
+    def close(self):
+        # Publish all batches and stop background thread.
+        with self.condition:
+            self.check_fork()
+            self.running = False
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,118 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from servicebus.future import Future
+
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+def make_key(target, params):
+    if isinstance(params, memoryview):
+        # Raw JSON params are used as they are.
+        return (target, params.tobytes().decode('utf-8'))
+    # Canonical JSON, so equal params with different key order hit same key.
+    return (target, json.dumps(params, sort_keys=True, separators=(',', ':')))
+
+
+class ResponseCache(object):
+    """
+    LRU cache of RPC responses for idempotent calls.
+
+    Only targets which have a TTL are cached. TTL can be set for a full
+    target (NODE.category.service) or for category.service on all nodes,
+    default_ttl is used for other targets. At most max_size responses are
+    kept, least recently used ones are evicted first.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, default_ttl=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttls = {}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def set_ttl(self, target, ttl):
+        self.ttls[target] = ttl
+
+    def get_ttl(self, target):
+        if target in self.ttls:
+            return self.ttls[target]
+        parts = target.split(".", 1)
+        if len(parts) == 2 and parts[1] in self.ttls:
+            return self.ttls[parts[1]]
+        return self.default_ttl
+
+    def get(self, target, params):
+        # Return (True, response) on hit, (False, None) on miss.
+        if not self.get_ttl(target):
+            return False, None
+        key = make_key(target, params)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return False, None
+            value, expire_at = entry
+            if expire_at < time.time():
+                return False, None
+            # Re-insert to mark it most recently used.
+            self.entries[key] = entry
+            return True, value
+
+    def put(self, target, params, value):
+        ttl = self.get_ttl(target)
+        if not ttl:
+            return
+        key = make_key(target, params)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, target=None, params=None):
+        with self.lock:
+            if target is None:
+                self.entries.clear()
+            elif params is not None:
+                self.entries.pop(make_key(target, params), None)
+            else:
+                for key in list(self.entries.keys()):
+                    if key[0] == target:
+                        del self.entries[key]
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical concurrent calls. The first caller of a key runs the
+    function, callers coming with same key before it finished wait for it
+    and get the same result or exception, or TimeoutException if it does
+    not finish in their own timeout.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, timeout, func, *args):
+        with self.lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.flights[key] = future
+        if not leader:
+            return future.result(timeout)
+
+        try:
+            value = func(*args)
+        except Exception as e:
+            self._finish(key)
+            future.set_exception(e)
+            raise e
+        self._finish(key)
+        future.set_result(value)
+        return value
+
+    def _finish(self, key):
+        with self.lock:
+            self.flights.pop(key, None)
@@ -0,0 +1,191 @@
+import json
+import struct
+from servicebus.event import Event
+from servicebus.message import Envelope
+from servicebus.parser import XmlMessageParser, XmlRequestGenerator, next_event_id
+
+
+DEFAULT_MESSAGE_CODEC = 'xml'
+JSON_CONTENT_TYPE = 'application/x-servicebus+json'
+BINARY_CONTENT_TYPE = 'application/x-servicebus+binary'
+HEADERS_CONTENT_TYPE = 'application/x-servicebus+headers'
+CATEGORY_HEADER = 'x-category'
+SERVICE_HEADER = 'x-service'
+TOKEN_HEADER = 'x-token'
+VERSION_HEADER = 'x-version'
+MESSAGE_VERSION = '1'
+
+CODECS = {}
+CONTENT_TYPES = {}
+
+
+def register_codec(codec, *content_types):
+    """
+    Register a request message codec. codec.name is used in configuration,
+    codec.content_type is set as AMQP content_type of messages it encodes.
+    Messages of codec.content_type and content_types are decoded by it.
+    """
+    CODECS[codec.name] = codec
+    CONTENT_TYPES[codec.content_type] = codec
+    for content_type in content_types:
+        CONTENT_TYPES[content_type] = codec
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise Exception("Unknown message codec: %s" % name)
+    return CODECS[name]
+
+
+def get_codec_by_content_type(content_type):
+    if content_type not in CONTENT_TYPES:
+        raise Exception("Unknown message content type: %s" % content_type)
+    return CONTENT_TYPES[content_type]
+
+
+def decode_event(body, properties):
+    # Decode request message body in bytes by its content_type.
+    codec = get_codec_by_content_type(getattr(properties, 'content_type', None))
+    return codec.decode(body, properties)
+
+
+def encode_params(params):
+    if isinstance(params, memoryview):
+        # Params already in JSON, e.g. from Request.get_raw_params.
+        return params.tobytes()
+    return json.dumps(params, separators=(',', ':')).encode('utf-8')
+
+
+class XmlCodec(object):
+    """
+    The original XML message format. Its messages have no content_type so
+    agents of old versions can read them.
+    """
+    name = 'xml'
+    content_type = None
+
+    def __init__(self):
+        self.parser = XmlMessageParser()
+
+    def encode(self, configuration, category, service, params):
+        return XmlRequestGenerator(configuration, category, service, params).to_xml()
+
+    def decode(self, body, properties=None):
+        return self.parser.parse(body)
+
+
+# JSON message format:
+#   {"version":"1","id":"EVENT_ID","token":"EVENT_TOKEN",
+#    "category":"EVENT_CATEGORY","service":"SERVICE_NAME","params":PARAMS}
+class JsonCodec(object):
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, configuration, category, service, params):
+        doc = encode_params({
+            'version': MESSAGE_VERSION,
+            'id': str(next_event_id()),
+            'token': configuration.token_cache.current_token(),
+            'category': category,
+            'service': service,
+        })
+        # Params are spliced in, so raw params are not decoded.
+        return doc[:-1] + b',"params":' + encode_params(params) + b'}'
+
+    def decode(self, body, properties=None):
+        try:
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            doc = json.loads(body)
+            return Event(doc['id'], doc['category'], doc['service'], doc['token'],
+                         doc['params'], doc['version'])
+        except Exception:
+            # if got any exception in parse return None
+            return None
+
+
+# Binary message format, integers are big endian:
+#   version         1 byte
+#   id, token, category, service
+#                   2 bytes length and UTF-8 string for each of them
+#   params          4 bytes length and JSON params in UTF-8
+class BinaryCodec(object):
+    name = 'binary'
+    content_type = BINARY_CONTENT_TYPE
+
+    def encode(self, configuration, category, service, params):
+        parts = [struct.pack('>B', int(MESSAGE_VERSION))]
+        for value in (str(next_event_id()), configuration.token_cache.current_token(), category, service):
+            value = value.encode('utf-8')
+            parts.append(struct.pack('>H', len(value)))
+            parts.append(value)
+        params = encode_params(params)
+        parts.append(struct.pack('>I', len(params)))
+        parts.append(params)
+        return b''.join(parts)
+
+    def decode(self, body, properties=None):
+        try:
+            if not isinstance(body, (bytes, memoryview)):
+                body = body.encode('utf-8')
+            # body may be a view of a batch message, slicing it copies nothing.
+            body = memoryview(body)
+            version = struct.unpack_from('>B', body, 0)[0]
+            offset = 1
+            fields = []
+            for i in range(4):
+                length = struct.unpack_from('>H', body, offset)[0]
+                offset += 2
+                fields.append(body[offset:offset + length].tobytes().decode('utf-8'))
+                offset += length
+            length = struct.unpack_from('>I', body, offset)[0]
+            offset += 4
+            if offset + length != len(body):
+                return None
+            eid, token, category, service = fields
+            event = Event(eid, category, service, token, None, str(version))
+            # Params are a view of body, no copy until they are decoded.
+            event.set_raw_params(body[offset:])
+            return event
+        except Exception:
+            # if got any exception in parse return None
+            return None
+
+
+# Headers message format:
+#   message_id      EVENT_ID
+#   headers         x-category, x-service, x-token and x-version
+#   body            JSON params in UTF-8
+# Receiver authenticates and routes by properties only.
+class HeadersCodec(object):
+    name = 'headers'
+    content_type = HEADERS_CONTENT_TYPE
+
+    def encode(self, configuration, category, service, params):
+        return Envelope(
+            encode_params(params),
+            message_id=str(next_event_id()),
+            headers={
+                CATEGORY_HEADER: category,
+                SERVICE_HEADER: service,
+                TOKEN_HEADER: configuration.token_cache.current_token(),
+                VERSION_HEADER: MESSAGE_VERSION,
+            }
+        )
+
+    def decode(self, body, properties=None):
+        try:
+            headers = properties.headers
+            event = Event(properties.message_id, headers[CATEGORY_HEADER], headers[SERVICE_HEADER],
+                          headers[TOKEN_HEADER], None, headers[VERSION_HEADER])
+        except Exception:
+            # if got any exception in parse return None
+            return None
+        event.set_raw_params(body)
+        return event
+
+
+register_codec(XmlCodec(), 'application/xml', 'text/xml')
+register_codec(JsonCodec(), 'application/json')
+register_codec(BinaryCodec())
+register_codec(HeadersCodec())
@@ -0,0 +1,51 @@
+import zlib
+
+
+DEFAULT_COMPRESS_CODEC = 'zlib'
+# Message header of content encodings a RPC caller can read in response
+ACCEPT_ENCODING_HEADER = 'x-accept-encoding'
+
+CODECS = {}
+
+
+def register_codec(name, compress_func, decompress_func):
+    """
+    Register a compression codec. name is used as AMQP content_encoding,
+    compress_func and decompress_func take and return bytes.
+    """
+    CODECS[name] = (compress_func, decompress_func)
+
+
+register_codec('zlib', zlib.compress, zlib.decompress)
+
+
+def compress(body, codec, threshold):
+    """
+    Compress body if it is not smaller than threshold bytes. Return the
+    body and its content encoding, which is None if body is not compressed.
+    """
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    if codec is None or threshold is None or len(body) < threshold:
+        return body, None
+    if codec not in CODECS:
+        raise Exception("Unknown compression codec: %s" % codec)
+    return CODECS[codec][0](body), codec
+
+
+def decompress(body, content_encoding):
+    # Content encoding which is not a registered codec is not compression,
+    # leave body as it is.
+    if not content_encoding or content_encoding not in CODECS:
+        return body
+    return CODECS[content_encoding][1](body)
+
+
+def accepted_encodings(properties):
+    headers = getattr(properties, 'headers', None)
+    if not headers or ACCEPT_ENCODING_HEADER not in headers:
+        return []
+    value = headers[ACCEPT_ENCODING_HEADER]
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value.split(',')
@@ -1,8 +1,16 @@
 import time
 import logging
-from servicebus.message import MessageSender
+from servicebus.message import MessageSender, REPLY_EXCLUSIVE, DEFAULT_PREFETCH_COUNT
 from servicebus.receiver import MessageBusReceiver
+from servicebus.parser import TokenCache
+from servicebus.codec import get_codec, DEFAULT_MESSAGE_CODEC
 from servicebus.command import get_host_name
+from servicebus.compression import DEFAULT_COMPRESS_CODEC
+from servicebus.cache import SingleFlight
+from servicebus.health import HostHealthCache, HostSelector, DEFAULT_HEALTH_TTL
+from servicebus.pool import ConnectionPool, DEFAULT_POOL_MAX_IDLE, DEFAULT_POOL_IDLE_TIMEOUT
+from servicebus.spool import Spool, SpoolDrainer
+from servicebus.batch import Batcher, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_BYTES
 
 
 DEFAULT_EXCHANGE_NAME = 'py-servicebus'
@@ -23,10 +31,50 @@ class Configuration(object):
     config['exchange_name'] = RabbitMQ Exchange name or use default:
                                 py-servicebus
     config['secret_token']  = Message token secret token seed
+    config['reply_mode']    = How RPC caller receive response: 'exclusive'
+                              (new queue per call, default), 'shared' (one
+                              queue per connection) or 'direct' (RabbitMQ
+                              direct reply-to)
+    config['keep_alive']    = True or False default is False, keep sender's
+                              connection open between sends
+    config['health_ttl']    = Seconds smart routing trusts a host's health
+                              without PING it again, default is 30
+    config['connection_pool']   = True or False default is False, senders
+                                  borrow connections from a per process pool
+    config['pool_max_idle']     = Max idle connections per host, default 8
+    config['pool_idle_timeout'] = Seconds before an idle connection is
+                                  closed, default is 30 or half of
+                                  heartbeat_interval if that is smaller
+    config['compress_threshold'] = Compress message not smaller than this
+                                   bytes, default is None (no compression)
+    config['compress_codec']     = Compression codec, default is 'zlib'
+    config['coalesce_calls']     = True or False default is False, identical
+                                   concurrent Sender.call share one request
+    config['spool_dir']          = Directory to spool Sender.send messages
+                                   when no host is reachable, default is None
+                                   (raise exception). Spooled messages are
+                                   replayed in background once a host is up.
+                                   While all hosts are down messages are
+                                   spooled without trying to connect
+    config['connect_retry']      = Times create_sender tries all hosts,
+                                   default is 3, or 1 if spool_dir is set
+    config['message_codec']      = Format of sent messages: 'xml' (default),
+                                   'json', 'binary' or 'headers'. Receivers
+                                   read all of them
+    config['batch_linger']       = Seconds Sender.send without ttl waits to
+                                   put events to same node in one message,
+                                   default is None (no batching)
+    config['batch_size']         = Max events in a batch, default 100
+    config['batch_bytes']        = Max bytes of a batch, default 131072
+    config['prefetch_count']     = Max unacked deliveries broker pushes to a
+                                   receiver, default is 1. A service's
+                                   prefetch_count attribute can raise it,
+                                   it does not change ServiceBus queue_len
     """
     def __init__(self, config):
         self.hosts = config['hosts']
         self.secret_token = config['secret_token']
+        self.token_cache = TokenCache(self.secret_token)
         self.port = 5672
         if 'port' in config:
             self.port = int(config['port'])
@@ -54,6 +102,47 @@ class Configuration(object):
         self.heartbeat_interval = 60
         if 'heartbeat_interval' in config:
             self.heartbeat_interval = config['heartbeat_interval']
+        self.reply_mode = REPLY_EXCLUSIVE
+        if 'reply_mode' in config:
+            self.reply_mode = config['reply_mode']
+        self.keep_alive = False
+        if 'keep_alive' in config:
+            self.keep_alive = config['keep_alive']
+        self.health_ttl = DEFAULT_HEALTH_TTL
+        if 'health_ttl' in config:
+            self.health_ttl = config['health_ttl']
+        self.health_cache = HostHealthCache(self.health_ttl)
+        self.host_selector = HostSelector()
+        self.prefetch_count = config.get('prefetch_count', DEFAULT_PREFETCH_COUNT)
+        self.compress_threshold = config.get('compress_threshold', None)
+        self.compress_codec = config.get('compress_codec', DEFAULT_COMPRESS_CODEC)
+        self.message_codec = get_codec(config.get('message_codec', DEFAULT_MESSAGE_CODEC))
+        self.single_flight = None
+        if config.get('coalesce_calls', False):
+            self.single_flight = SingleFlight()
+        self.connection_pool = None
+        if config.get('connection_pool', False):
+            self.connection_pool = ConnectionPool(
+                config.get('pool_max_idle', DEFAULT_POOL_MAX_IDLE),
+                config.get('pool_idle_timeout', self.get_pool_idle_timeout())
+            )
+        self.spool = None
+        self.spool_drainer = None
+        self.connect_retry = 3
+        if config.get('spool_dir', None) is not None:
+            self.spool = Spool(config['spool_dir'])
+            # Spool instead of waiting for hosts.
+            self.connect_retry = 1
+        if 'connect_retry' in config:
+            self.connect_retry = config['connect_retry']
+        self.batcher = None
+        if config.get('batch_linger', None) is not None:
+            self.batcher = Batcher(
+                self,
+                config['batch_linger'],
+                config.get('batch_size', DEFAULT_BATCH_SIZE),
+                config.get('batch_bytes', DEFAULT_BATCH_BYTES)
+            )
 
     """
     Thie method will create a message receiver.
@@ -69,6 +158,8 @@ class Configuration(object):
             self.socket_timeout,
             self.heartbeat_interval
         )
+        receiver.set_compression(self.compress_codec, self.compress_threshold)
+        receiver.set_prefetch_count(self.prefetch_count)
         try:
             receiver.ensure_connection()
         except Exception as e:
@@ -80,15 +171,28 @@ class Configuration(object):
             raise e
         return receiver
 
+    """
+    Prefetch count of a receiver of services, the largest one of
+    configuration and services' prefetch_count attributes.
+    """
+    def get_prefetch_count(self, services):
+        prefetch_count = self.prefetch_count
+        for service in services:
+            if hasattr(service, 'prefetch_count'):
+                prefetch_count = max(prefetch_count, service.prefetch_count)
+        return prefetch_count
+
     """
     This method will get an availiable host to send message to.
     """
     def create_sender(self, reverse=False):
-        for i in range(3):
+        caller = None
+        for i in range(self.connect_retry):
+            if i > 0:
+                time.sleep(1)
             caller = self.__get_availiable_message_sender(reverse)
             if caller is not None:
                 break
-            time.sleep(1)
 
         if not caller:
             raise Exception("Cannot Connect to Message Queue!")
@@ -103,13 +207,20 @@ class Configuration(object):
         ret = []
         for host in self.hosts:
             try:
-                caller = self.__create_message_sender(host)
-                caller.ensure_connection()
+                caller = self.__connect_message_sender(host)
                 ret.append(caller)
             except Exception as e:
                 logging.exception(e)
+                self.host_selector.record_connect_failure(host)
         return ret
 
+    def get_pool_idle_timeout(self):
+        # Pooled connection should not be idle long enough to be dropped
+        # for missed heartbeats.
+        if self.heartbeat_interval:
+            return min(DEFAULT_POOL_IDLE_TIMEOUT, self.heartbeat_interval / 2.0)
+        return DEFAULT_POOL_IDLE_TIMEOUT
+
     def queue_name(self):
         return self.node_name
 
@@ -124,15 +235,58 @@ class Configuration(object):
         hosts = self.hosts[:]
         if reverse:
             hosts.reverse()
-        for host in hosts:
+        for host in self.host_selector.sort(hosts):
             try:
-                caller = self.__create_message_sender(host)
-                caller.ensure_connection()
-                return caller
+                return self.__connect_message_sender(host)
             except Exception as e:
                 logging.exception(e)
+                self.host_selector.record_connect_failure(host)
         return None
 
+    """
+    Give back a sender got from create_sender or create_senders. It will
+    be returned to connection pool if pool is enabled, otherwise closed.
+    """
+    def release_sender(self, caller):
+        if self.connection_pool is not None:
+            self.connection_pool.release(caller)
+        else:
+            caller.close()
+
+    """
+    Save a message to local spool, it will be sent by spool drainer thread
+    when a host can be connected.
+    """
+    def spool_message(self, target, msg):
+        self.spool.append(target, msg)
+        self.start_spool_drainer()
+
+    """
+    Start spool drainer thread, call it on start up to replay messages
+    spooled by last run.
+    """
+    def start_spool_drainer(self):
+        if self.spool is None:
+            return
+        if self.spool_drainer is None or not self.spool_drainer.is_alive():
+            self.spool_drainer = SpoolDrainer(self.spool, self)
+            self.spool_drainer.start()
+
+    def __connect_message_sender(self, host):
+        if self.connection_pool is not None:
+            caller = self.connection_pool.acquire(host, lambda: self.__create_pooled_message_sender(host))
+        else:
+            caller = self.__create_message_sender(host)
+            caller.ensure_connection()
+        self.host_selector.record_connect_success(host)
+        return caller
+
+    def __create_pooled_message_sender(self, host):
+        caller = self.__create_message_sender(host)
+        # Pooled connection should survive send.
+        caller.set_keep_alive(True)
+        return caller
+
     def __create_message_sender(self, host):
         caller = MessageSender(
             host,
@@ -140,6 +294,11 @@ class Configuration(object):
             self.user,
             self.password,
             self.use_ssl,
-            self.socket_timeout
+            self.socket_timeout,
+            self.heartbeat_interval
         )
+        caller.set_reply_mode(self.reply_mode)
+        caller.set_keep_alive(self.keep_alive)
+        caller.set_compression(self.compress_codec, self.compress_threshold)
+        caller.set_content_type(self.message_codec.content_type)
         return caller
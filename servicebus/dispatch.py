@@ -0,0 +1,86 @@
+import logging
+from servicebus.codec import decode_event, get_codec
+from servicebus.batch import decode_batch, BATCH_CONTENT_TYPE
+from servicebus.message import get_deadline
+from servicebus.parser import XmlResponseGenerator
+
+
+# Messages of error replies sent by dispatcher instead of a service
+TOKEN_ERROR = "Token not valid!"
+NO_SERVICE_ERROR = "Cannot Find RPC Service: "
+
+
+def is_error_reply(response):
+    # response is (id, message) of XmlResponseParser.
+    message = response[1] or ''
+    return message == TOKEN_ERROR or message.startswith(NO_SERVICE_ERROR)
+
+
+def decode_events(header, body):
+    # Events of a request message, a batch message has many of them.
+    if getattr(header, 'content_type', None) == BATCH_CONTENT_TYPE:
+        codec = get_codec('binary')
+        return [codec.decode(msg) for msg in decode_batch(body)]
+    return [decode_event(body, header)]
+
+
+class EventDispatcher(object):
+    """
+    Decode, authenticate and route request messages to services. Shared by
+    MessageBusReceiver and AsyncMessageBusReceiver.
+
+    Receiver should have message_parser and response_message, and implement
+    lookup_rpc_service, lookup_message_service, call_rpc_service and
+    call_message_service. context is passed as it is to response_message
+    and call_rpc_service before their own arguments.
+    """
+    def dispatch_rpc(self, header, body, *context):
+        event = decode_event(body, header)
+        if event is None:
+            logging.error('Cannot decode RPC message')
+            return
+        event.deadline = get_deadline(header)
+        if not self.message_parser.validate_token(event.token):
+            logging.error('Token Error')
+            self.reply_error(header, event, TOKEN_ERROR, *context)
+            return
+
+        service = self.lookup_rpc_service(event.category, event.service)
+        if service is None:
+            error_msg = '%s%s.%s' % (NO_SERVICE_ERROR, event.category, event.service)
+            logging.error(error_msg)
+            self.reply_error(header, event, error_msg, *context)
+            return
+
+        logging.info("Call RPC Service %s.%s" % (event.category, event.service))
+        self.call_rpc_service(*(context + (service, event, header)))
+
+    def reply_error(self, header, event, error_msg, *context):
+        msg = XmlResponseGenerator(event.id, error_msg)
+        self.response_message(*(context + (header, msg.to_xml())))
+
+    def dispatch_message(self, header, body):
+        for event in decode_events(header, body):
+            try:
+                self.dispatch_message_event(header, event)
+            except Exception as e:
+                # One bad event should not lose the rest of batch.
+                logging.exception(e)
+
+    def dispatch_message_event(self, header, event):
+        if event is None:
+            logging.error('Cannot decode message')
+            return
+        event.deadline = get_deadline(header)
+        if not self.message_parser.validate_token(event.token):
+            logging.error('Token Error')
+            return
+
+        service = self.lookup_message_service(event.category, event.service)
+        if service is None:
+            error_msg = 'Cannot Find Message Service: %s.%s' % (event.category, event.service)
+            logging.error(error_msg)
+            return
+
+        logging.info("Call Message Service %s.%s" % (event.category, event.service))
+        self.call_message_service(service, event, header)
@@ -1,8 +1,43 @@
+import json
+
+
 class Event(object):
-    def __init__(self, eid, category, service, token, params, version):
+    def __init__(self, eid, category, service, token, params, version, deadline=None):
         self.id = eid
         self.category = category
         self.service = service
         self.token = token
+        self.raw_params = None
         self.params = params
         self.version = version
+        # Absolute time after which nobody waits for the result
+        self.deadline = deadline
+
+    @property
+    def params(self):
+        if not self.params_decoded:
+            self.params_value = json.loads(self.raw_params.tobytes().decode('utf-8'))
+            self.params_decoded = True
+        return self.params_value
+
+    @params.setter
+    def params(self, value):
+        self.params_value = value
+        self.params_decoded = True
+
+    def set_raw_params(self, raw):
+        """
+        Set JSON params in UTF-8 bytes. They are kept as a memoryview of the
+        message body and decoded on first access of params, so routing,
+        authentication and pass-through services do not pay for it.
+        """
+        self.raw_params = memoryview(raw)
+        self.params_value = None
+        self.params_decoded = False
+
+    def get_raw_params(self):
+        # memoryview of JSON params in UTF-8, it can be sent as params of
+        # Sender's call and send without decoding.
+        if self.raw_params is None:
+            self.raw_params = memoryview(json.dumps(self.params).encode('utf-8'))
+        return self.raw_params
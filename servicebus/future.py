@@ -0,0 +1,89 @@
+import logging
+import threading
+from servicebus.message import TimeoutException
+
+
+class Future(object):
+    """
+    Result holder of an asynchronous operation. It will be resolved by
+    the I/O thread with set_result or set_exception, other threads can
+    wait for it with result.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self, value):
+        return self._finish(value, None)
+
+    def set_exception(self, error):
+        return self._finish(None, error)
+
+    def _finish(self, value, error):
+        with self.condition:
+            if self.finished:
+                return False
+            self.value = value
+            self.error = error
+            self.finished = True
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notify_all()
+        for callback in callbacks:
+            self._run_callback(callback)
+        return True
+
+    def wait(self, timeout=None):
+        with self.condition:
+            if not self.finished:
+                self.condition.wait(timeout)
+            return self.finished
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutException("Timeout")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutException("Timeout")
+        return self.error
+
+    def add_done_callback(self, callback):
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def then(self, func):
+        """
+        Return a new future resolved with func(result) of this one.
+        """
+        future = Future()
+
+        def on_done(source):
+            if source.error is not None:
+                future.set_exception(source.error)
+                return
+            try:
+                future.set_result(func(source.value))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.add_done_callback(on_done)
+        return future
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logging.exception(e)
@@ -0,0 +1,156 @@
+import time
+import threading
+
+
+DEFAULT_HEALTH_TTL = 30
+
+
+class HostHealthCache(object):
+    """
+    Remember whether a target node can be reached through a RabbitMQ host,
+    so smart routing need not PING before every call. Entries are updated
+    by PING results and passively by success or failure of real calls,
+    and expire after ttl seconds.
+    """
+    def __init__(self, ttl=DEFAULT_HEALTH_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, host, target):
+        # Return True or False, or None if state is unknown or expired.
+        with self.lock:
+            entry = self.entries.get((host, target))
+        if entry is None:
+            return None
+        healthy, expire_at = entry
+        if expire_at < time.time():
+            return None
+        return healthy
+
+    def mark(self, host, target, healthy):
+        with self.lock:
+            self.entries[(host, target)] = (healthy, time.time() + self.ttl)
+
+    def invalidate(self, host=None, target=None):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if host is not None and key[0] != host:
+                    continue
+                if target is not None and key[1] != target:
+                    continue
+                del self.entries[key]
+
+
+DEFAULT_EWMA_ALPHA = 0.3
+# Seconds added to a host's score for 100% error rate
+DEFAULT_ERROR_PENALTY = 1.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+# Seconds a failed connect to a host is believed without trying again
+DEFAULT_CONNECT_FAILURE_TTL = 5
+
+
+class HostStats(object):
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+        self.connect_failed_at = 0
+
+
+class HostSelector(object):
+    """
+    Rank RabbitMQ hosts by EWMA of publish/RPC latency and error rate.
+    Only connection and channel errors count, a timeout of a target node is
+    kept in HostHealthCache.
+
+    Score of a host is latency + error_rate * error_penalty, lower is
+    better. A host failing failure_threshold times in a row opens its
+    circuit breaker: it is ranked after all other hosts for open_seconds.
+    After that it is ranked normally again (half open) and one more failure
+    opens the breaker again, one success closes it.
+
+    A host is down while its breaker is open or it could not be connected
+    in the last connect_failure_ttl seconds.
+    """
+    def __init__(self, alpha=DEFAULT_EWMA_ALPHA, error_penalty=DEFAULT_ERROR_PENALTY,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, open_seconds=DEFAULT_OPEN_SECONDS,
+                 connect_failure_ttl=DEFAULT_CONNECT_FAILURE_TTL):
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.connect_failure_ttl = connect_failure_ttl
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _get_stats(self, host):
+        stats = self.stats.get(host)
+        if stats is None:
+            stats = HostStats()
+            self.stats[host] = stats
+        return stats
+
+    def record_success(self, host, latency):
+        with self.lock:
+            stats = self._get_stats(host)
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.alpha * (latency - stats.latency)
+            stats.error_rate -= self.alpha * stats.error_rate
+            stats.failures = 0
+            stats.open_until = 0
+
+    def record_failure(self, host):
+        with self.lock:
+            stats = self._get_stats(host)
+            stats.error_rate += self.alpha * (1.0 - stats.error_rate)
+            stats.failures += 1
+            if stats.failures >= self.failure_threshold:
+                stats.open_until = time.time() + self.open_seconds
+
+    def record_connect_failure(self, host):
+        self.record_failure(host)
+        with self.lock:
+            self._get_stats(host).connect_failed_at = time.time()
+
+    def record_connect_success(self, host):
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is not None:
+                stats.connect_failed_at = 0
+
+    def is_open(self, host):
+        return self.rank(host)[0]
+
+    def is_down(self, host):
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is None:
+                return False
+            now = time.time()
+            return stats.open_until > now or stats.connect_failed_at > now - self.connect_failure_ttl
+
+    def all_down(self, hosts):
+        for host in hosts:
+            if not self.is_down(host):
+                return False
+        return True
+
+    def rank(self, host):
+        # Return (breaker opened, score), smaller is better.
+        with self.lock:
+            stats = self.stats.get(host)
+            if stats is None:
+                return (False, 0.0)
+            return (stats.open_until > time.time(),
+                    (stats.latency or 0.0) + stats.error_rate * self.error_penalty)
+
+    def sort(self, items, key=None):
+        # Stable sort, so hosts with same rank keep configured order.
+        if key is None:
+            return sorted(items, key=self.rank)
+        return sorted(items, key=lambda item: self.rank(key(item)))
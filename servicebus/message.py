@@ -1,16 +1,95 @@
+import time
 import uuid
 import signal
 import logging
 from datetime import datetime
 from servicebus import pika
+from servicebus.pika import spec
 from servicebus import utils
+from servicebus import compression
 from servicebus.watcher import PingWatcher
 
 
+# Reply modes of MessageSender.call:
+#   exclusive: declare a new exclusive queue for every call (default)
+#   shared:    declare one exclusive queue per connection and reuse it
+#   direct:    use RabbitMQ direct reply-to pseudo queue
+REPLY_EXCLUSIVE = 'exclusive'
+REPLY_SHARED = 'shared'
+REPLY_DIRECT = 'direct'
+REPLY_MODES = (REPLY_EXCLUSIVE, REPLY_SHARED, REPLY_DIRECT)
+DIRECT_REPLY_TO_QUEUE = 'amq.rabbitmq.reply-to'
+# Message header of caller's absolute deadline, milliseconds since epoch
+# in a string since pika cannot encode 64 bit integer on Python 3
+DEADLINE_HEADER = 'x-deadline'
+# Message headers of streaming RPC response chunks and end marker
+STREAM_SEQ_HEADER = 'x-stream-seq'
+STREAM_END_HEADER = 'x-stream-end'
+STREAM_ERROR_HEADER = 'x-stream-error'
+DEFAULT_STREAM_PREFETCH = 10
+# Max seconds send_many blocks in broker I/O while waiting for confirms
+CONFIRM_POLL_INTERVAL = 0.01
+# Unacked deliveries broker pushes to a receiver before waiting for acks
+DEFAULT_PREFETCH_COUNT = 1
+
+
 class TimeoutException(Exception):
     pass
 
 
+def is_broker_error(error):
+    # Error of RabbitMQ connection or channel. Other errors of a call, like
+    # timeout, are about the target node.
+    return isinstance(error, (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError,
+                              EnvironmentError))
+
+
+def deadline_properties(timeout, **kwargs):
+    """
+    Build BasicProperties carrying caller's deadline. The expiration lets
+    broker drop the message if it waits in queue too long, the header lets
+    receiver drop it if it is expired before processing.
+    """
+    if timeout is not None:
+        kwargs['expiration'] = str(int(timeout * 1000))
+        headers = kwargs.setdefault('headers', {})
+        headers[DEADLINE_HEADER] = str(int((time.time() + timeout) * 1000))
+    return pika.BasicProperties(**kwargs)
+
+
+class Envelope(object):
+    """
+    Message body with AMQP properties to publish with it, e.g. headers and
+    message_id. Senders accept it wherever they accept a message body.
+    """
+    def __init__(self, body, **properties):
+        self.body = body
+        self.properties = properties
+
+
+def decode_body(body, properties):
+    return decompress_body(body, properties).decode()
+
+
+def decompress_body(body, properties):
+    content_encoding = getattr(properties, 'content_encoding', None)
+    return compression.decompress(body, content_encoding)
+
+
+def get_deadline(header):
+    headers = getattr(header, 'headers', None)
+    if not headers or DEADLINE_HEADER not in headers:
+        return None
+    try:
+        return int(headers[DEADLINE_HEADER]) / 1000.0
+    except (TypeError, ValueError):
+        return None
+
+
+def is_expired(deadline):
+    return deadline is not None and deadline < time.time()
+
+
 class RabbitMQMessageDriver(object):
     """docstring for AbstractMessageReceiver"""
     def __init__(self, host, port, username, password, ssl=False, socket_timeout=5, heartbeat_interval=60):
@@ -25,6 +104,13 @@ class RabbitMQMessageDriver(object):
         self.connected = False
         self.socket_timeout = socket_timeout
         self.heartbeat_interval = heartbeat_interval
+        self.compress_codec = None
+        self.compress_threshold = None
+
+    def set_compression(self, codec, threshold):
+        # Compress message body not smaller than threshold bytes with codec.
+        self.compress_codec = codec
+        self.compress_threshold = threshold
 
     def create_connection(self):
         connection = pika.BlockingConnection(pika.ConnectionParameters(
@@ -59,6 +145,13 @@ class RabbitMQMessageDriver(object):
 
 
 class AbstractReceiver(RabbitMQMessageDriver):
+    prefetch_count = DEFAULT_PREFETCH_COUNT
+
+    def set_prefetch_count(self, prefetch_count):
+        # Messages are acked on receive, so a larger prefetch keeps more
+        # deliveries in flight on high latency links.
+        self.prefetch_count = prefetch_count
+
     # this mothod just receive one message.
     # only used by test.
     def receive_one(self):
@@ -111,11 +204,17 @@ class AbstractReceiver(RabbitMQMessageDriver):
         except Exception:
             pass
 
-    def response_message(self, channel, method, header, message):
+    def response_message(self, channel, method, header, message, headers=None):
+        codec = None
+        if self.compress_codec in compression.accepted_encodings(header):
+            codec = self.compress_codec
+        body, content_encoding = compression.compress(message, codec, self.compress_threshold)
         channel.basic_publish(exchange='',
                               routing_key=header.reply_to,
-                              properties=pika.BasicProperties(correlation_id=header.correlation_id),
-                              body=message.encode())
+                              properties=pika.BasicProperties(correlation_id=header.correlation_id,
+                                                              content_encoding=content_encoding,
+                                                              headers=headers),
+                              body=body)
 
     def on_rpc(self, channel, method, header, body):
         self.response_message(channel, method, header, None)
@@ -124,7 +223,7 @@ class AbstractReceiver(RabbitMQMessageDriver):
         pass
 
     def start_receive(self, count=None):
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.channel.basic_consume(self.__on_receive, queue=self.queue_name)
         self.watcher = PingWatcher.start_watch(self)
         try:
@@ -149,10 +248,15 @@ class AbstractReceiver(RabbitMQMessageDriver):
     def __on_receive(self, channel, method, header, body):
         try:
             channel.basic_ack(delivery_tag=method.delivery_tag)
-            ebody = body.decode()
+            if is_expired(get_deadline(header)):
+                # Caller has given up, nobody waits for the result.
+                logging.warning("Drop expired message")
+                return
+            # Body is left in bytes, its codec is chosen by content_type.
+            ebody = decompress_body(body, header)
             if hasattr(header, 'reply_to') and header.reply_to is not None:
                 # Here is a RPC call
-                if ebody == "PING":
+                if ebody == b"PING":
                     self.response_message(channel, method, header, "PONG")
                 else:
                     self.on_rpc(channel, method, header, ebody)
@@ -164,43 +268,313 @@ class AbstractReceiver(RabbitMQMessageDriver):
 
 
 class AbstractMessageSender(RabbitMQMessageDriver):
+    exchange_name = None
+    keep_alive = False
+    content_type = None
+
     def set_exchange(self, exchange_name, exchange_type='direct'):
+        # Reused connection (keep alive or pooled) has declared it already.
+        if self.connected and self.exchange_name == exchange_name:
+            return
         self.exchange_name = exchange_name
         self.declare_exchange(exchange_name, exchange_type)
 
-    def send(self, target, msg):
+    def set_keep_alive(self, keep_alive):
+        self.keep_alive = keep_alive
+
+    def is_healthy(self):
+        if not self.connected:
+            return False
+        try:
+            # is_open flags are local state. Handle pending I/O first, it
+            # sends due heartbeats and notices a connection closed by broker.
+            self.connection.process_data_events(0)
+            return self.connection.is_open and self.channel.is_open
+        except Exception:
+            return False
+
+    def ensure_connection(self):
+        if self.connected and not self.is_healthy():
+            logging.info("Connection to %s is broken, reconnect" % self.host)
+            self.safe_close()
+        super(AbstractMessageSender, self).ensure_connection()
+
+    def safe_close(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def set_content_type(self, content_type):
+        # AMQP content_type of messages, it tells receiver the message codec.
+        self.content_type = content_type
+
+    def build_message(self, msg, timeout=None, **kwargs):
+        # Return body and properties to publish msg.
+        if self.content_type is not None:
+            kwargs.setdefault('content_type', self.content_type)
+        headers = {}
+        if isinstance(msg, Envelope):
+            for key, value in msg.properties.items():
+                if key == 'headers':
+                    headers.update(value)
+                else:
+                    kwargs[key] = value
+            msg = msg.body
+        body, content_encoding = compression.compress(msg, self.compress_codec, self.compress_threshold)
+        if content_encoding is not None:
+            kwargs['content_encoding'] = content_encoding
+        if self.compress_threshold is not None and 'reply_to' in kwargs:
+            # Let receiver know it can compress the response.
+            headers[compression.ACCEPT_ENCODING_HEADER] = ','.join(sorted(compression.CODECS))
+        if len(headers) > 0:
+            kwargs['headers'] = headers
+        return body, deadline_properties(timeout, **kwargs)
+
+    def send(self, target, msg, ttl=None):
+        if self.keep_alive:
+            self.send_keep_alive(target, msg, ttl)
+            return
         try:
             self.ensure_connection()
-            self.channel.basic_publish(exchange=self.exchange_name, routing_key=str(target), body=msg)
+            body, properties = self.build_message(msg, ttl)
+            self.channel.basic_publish(exchange=self.exchange_name, routing_key=str(target),
+                                       properties=properties, body=body)
         finally:
             self.close()
 
+    def send_many(self, messages, timeout=30):
+        """
+        Publish a list of (target, msg) on one channel in publisher confirm
+        mode. Messages are pipelined and broker acks are tracked by delivery
+        tag. Return a list of True (ack) or False (nack or not confirmed in
+        timeout) for each message.
+        """
+        results = [None] * len(messages)
+        # Delivery tags of confirm mode channel start from 1, so message
+        # results[i] has delivery tag i + 1.
+        state = {'lowest': 1}
+
+        def on_confirm(frame):
+            ok = isinstance(frame.method, spec.Basic.Ack)
+            tag = frame.method.delivery_tag
+            if frame.method.multiple:
+                first = state['lowest']
+            else:
+                first = tag
+            for i in range(first, tag + 1):
+                if results[i - 1] is None:
+                    results[i - 1] = ok
+            while state['lowest'] <= len(results) and results[state['lowest'] - 1] is not None:
+                state['lowest'] += 1
+
+        channel = None
+        try:
+            self.ensure_connection()
+            channel = self.connection.channel()
+            channel.confirm_delivery(on_confirm)
+            deadline = time.time() + timeout
+            published = 0
+            for target, msg in messages:
+                if time.time() >= deadline:
+                    break
+                body, properties = self.build_message(msg)
+                channel.basic_publish(exchange=self.exchange_name, routing_key=str(target),
+                                      properties=properties, body=body)
+                published += 1
+
+            while state['lowest'] <= published:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # Confirms do not end process_data_events early, so poll in
+                # short slices to return as soon as the last one arrives.
+                self.connection.process_data_events(min(remaining, CONFIRM_POLL_INTERVAL))
+            if state['lowest'] <= len(results):
+                logging.error("Timeout waiting for publish confirms of %d messages" %
+                              (len(results) - state['lowest'] + 1))
+        finally:
+            if not self.keep_alive:
+                self.close()
+            elif channel is not None:
+                try:
+                    channel.close()
+                except Exception:
+                    self.safe_close()
+        return [ret is True for ret in results]
+
+    def send_keep_alive(self, target, msg, ttl=None):
+        # Keep connection open between sends. Broker may drop an idle
+        # connection, so retry once on a fresh one.
+        for i in range(2):
+            try:
+                self.ensure_connection()
+                body, properties = self.build_message(msg, ttl)
+                self.channel.basic_publish(exchange=self.exchange_name, routing_key=str(target),
+                                           properties=properties, body=body)
+                return
+            except Exception as e:
+                self.safe_close()
+                if i > 0:
+                    raise e
+
 
 class MessageSender(AbstractMessageSender):
+    reply_mode = REPLY_EXCLUSIVE
+    callback_queue = None
+    callback_consumer = None
+    callback = None
+    corr_id = None
+
+    def set_reply_mode(self, reply_mode):
+        if reply_mode not in REPLY_MODES:
+            raise Exception("Unknown reply mode: %s" % reply_mode)
+        self.reply_mode = reply_mode
+
+    def close(self):
+        # Reply queue and its consumer are gone with the connection.
+        self.callback_queue = None
+        self.callback_consumer = None
+        self.callback = None
+        super(MessageSender, self).close()
+
+    def ensure_callback_queue(self, callback=None):
+        if callback is None:
+            callback = self.on_shared_response
+        if self.callback_queue is None:
+            if self.reply_mode == REPLY_DIRECT:
+                queue = DIRECT_REPLY_TO_QUEUE
+            else:
+                result = self.channel.queue_declare(exclusive=True, auto_delete=True)
+                queue = result.method.queue
+            self.callback_queue = queue
+        if self.callback != callback:
+            # A pooled sender may still consume for its last user, e.g.
+            # Sender.call before an RPCClient got it.
+            if self.callback_consumer is not None:
+                self.channel.basic_cancel(self.callback_consumer)
+            self.callback_consumer = self.channel.basic_consume(callback, queue=self.callback_queue, no_ack=True)
+            self.callback = callback
+        return self.callback_queue
+
+    def on_shared_response(self, ch, method, props, body):
+        # Late responses of timed out calls has a stale correlation id,
+        # just drop them.
+        if props.correlation_id == self.corr_id:
+            self.response = decode_body(body, props)
+
     def on_response(self, ch, method, props, body):
         if props.correlation_id == self.corr_id:
-            self.response = body.decode()
+            self.response = decode_body(body, props)
             self.connection.remove_timeout(self.timeout_id)
             self.timeout_id = None
             self.channel.stop_consuming()
 
     def call(self, target, msg, timeout=300):
+        if self.reply_mode == REPLY_EXCLUSIVE:
+            return self.call_exclusive(target, msg, timeout)
+        return self.call_shared(target, msg, timeout)
+
+    def call_shared(self, target, msg, timeout=300):
+        self.ensure_connection()
+        self.response = None
+        try:
+            self.corr_id = str(uuid.uuid4())
+            callback_queue = self.ensure_callback_queue()
+            body, properties = self.build_message(
+                msg,
+                timeout,
+                reply_to=callback_queue,
+                correlation_id=self.corr_id,
+            )
+            self.channel.basic_publish(
+                exchange=self.exchange_name,
+                routing_key=str(target),
+                properties=properties,
+                body=body)
+
+            deadline = time.time() + timeout
+            while self.response is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutException("Timeout")
+                self.connection.process_data_events(remaining)
+            return self.response
+        except Exception as e:
+            logging.exception(e)
+            raise e
+        finally:
+            self.corr_id = None
+
+    def call_stream(self, target, msg, timeout=300, prefetch=DEFAULT_STREAM_PREFETCH):
+        """
+        Generator of response chunks of a streaming RPC call. timeout is max
+        seconds to wait for each chunk. Chunks are received on a dedicated
+        channel and queue with manual ack and prefetch, so chunks not consumed
+        yet wait in broker instead of in memory.
+        """
+        self.ensure_connection()
+        channel = self.connection.channel()
+        try:
+            result = channel.queue_declare(exclusive=True, auto_delete=True)
+            callback_queue = result.method.queue
+            channel.basic_qos(prefetch_count=prefetch)
+            corr_id = str(uuid.uuid4())
+            body, properties = self.build_message(
+                msg,
+                timeout,
+                reply_to=callback_queue,
+                correlation_id=corr_id,
+            )
+            channel.basic_publish(
+                exchange=self.exchange_name,
+                routing_key=str(target),
+                properties=properties,
+                body=body)
+
+            for method, props, body in channel.consume(callback_queue, inactivity_timeout=timeout):
+                if method is None:
+                    raise TimeoutException("Timeout")
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                if props.correlation_id != corr_id:
+                    continue
+                headers = props.headers or {}
+                if STREAM_ERROR_HEADER in headers:
+                    raise Exception("Stream error: %s" % headers[STREAM_ERROR_HEADER])
+                if STREAM_END_HEADER in headers:
+                    return
+                yield decode_body(body, props)
+                if STREAM_SEQ_HEADER not in headers:
+                    # Service sent a normal response
+                    return
+        finally:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+    def call_exclusive(self, target, msg, timeout=300):
         self.ensure_connection()
         self.response = None
         self.timeout = False
         self.timeout_id = None
         try:
             self.corr_id = str(uuid.uuid4())
-            result = self.channel.queue_declare(exclusive=True)
+            # Queue is deleted once its consumer is cancelled, pooled
+            # connections live long.
+            result = self.channel.queue_declare(exclusive=True, auto_delete=True)
             callback_queue = result.method.queue
+            body, properties = self.build_message(
+                msg,
+                timeout,
+                reply_to=callback_queue,
+                correlation_id=self.corr_id,
+            )
             self.channel.basic_publish(
                 exchange=self.exchange_name,
                 routing_key=str(target),
-                properties=pika.BasicProperties(
-                    reply_to=callback_queue,
-                    correlation_id=self.corr_id,
-                ),
-                body=msg)
+                properties=properties,
+                body=body)
             self.channel.basic_consume(self.on_response, queue=callback_queue)
 
             def timeout_callback():
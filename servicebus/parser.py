@@ -1,7 +1,10 @@
 import json
+import hmac
+import time
 import hashlib
+import threading
 from datetime import datetime, timedelta
-from xml.dom.minidom import parseString
+from xml.parsers import expat
 from servicebus.event import Event
 
 
@@ -14,10 +17,65 @@ def do_generate_token(configuration, date=None):
         datestr = (datetime.now() - td).isoformat()[:10]
     elif date == "next":
         datestr = (datetime.now() + td).isoformat()[:10]
+    return hash_token(key, datestr)
+
+
+def hash_token(key, datestr):
     token_str = "%s - %s" % (key, datestr)
     return hashlib.sha1(token_str.encode()).hexdigest()
 
 
+class TokenCache(object):
+    """
+    Tokens of yesterday, today and tomorrow computed once per day. They are
+    recomputed on first use after local midnight.
+    """
+    def __init__(self, secret_token):
+        self.secret_token = secret_token
+        self.lock = threading.Lock()
+        # (expire time, current token, valid tokens) replaced as a whole so
+        # readers need no lock.
+        self.state = (0, None, ())
+
+    def refresh(self):
+        with self.lock:
+            if time.time() < self.state[0]:
+                return self.state
+            now = datetime.now()
+            td = timedelta(1)
+            tomorrow = (now + td).replace(hour=0, minute=0, second=0, microsecond=0)
+            tokens = [hash_token(self.secret_token, day.isoformat()[:10]) for day in (now, now - td, now + td)]
+            self.state = (
+                time.mktime(tomorrow.timetuple()),
+                tokens[0],
+                tuple(token.encode() for token in tokens)
+            )
+            return self.state
+
+    def get_state(self):
+        state = self.state
+        if time.time() >= state[0]:
+            state = self.refresh()
+        return state
+
+    def current_token(self):
+        return self.get_state()[1]
+
+    def validate(self, token):
+        if token is None:
+            return False
+        if not isinstance(token, bytes):
+            try:
+                token = token.encode('ascii')
+            except UnicodeError:
+                return False
+        ret = False
+        # Compare with all tokens in constant time.
+        for valid in self.get_state()[2]:
+            ret = hmac.compare_digest(valid, token) | ret
+        return ret
+
+
 class AbstractMessageParser(object):
     def set_configuration(self, configuration):
         self.configuration = configuration
@@ -26,29 +84,47 @@ class AbstractMessageParser(object):
         return do_generate_token(self.configuration, date)
 
 
-class XmlParserHelper(object):
-    def get_text(self, node):
-        rc = []
-        for child in node.childNodes:
-            if child.nodeType == node.TEXT_NODE or child.nodeType == node.CDATA_SECTION_NODE:
-                rc.append(child.data)
-        return ''.join(rc)
-
-
-class JSONParamsParser(XmlParserHelper):
-    def __init__(self):
-        self.params = {}
-
-    def parse(self):
-        params_node = self.params_node
-        self.parse_param(params_node)
-
-    def set_params_node(self, value):
-        self.params_node = value
-
-    def parse_param(self, params_node):
-        json_code = self.get_text(params_node)
-        self.params = json.loads(json_code)
+class XmlScanner(object):
+    """
+    Collect text of root element's children in one pass of expat, no DOM
+    is built. Only the first child of each name in names is kept.
+    """
+    def __init__(self, names):
+        self.names = names
+        self.root = None
+        self.attrs = None
+        self.texts = {}
+        self.depth = 0
+        self.current = None
+        self.buffer = []
+
+    def scan(self, xml_doc):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.on_start
+        parser.EndElementHandler = self.on_end
+        parser.CharacterDataHandler = self.on_data
+        parser.Parse(xml_doc, True)
+        return self
+
+    def on_start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self.root = name
+            self.attrs = attrs
+        elif self.depth == 2 and name in self.names and name not in self.texts:
+            self.current = name
+            self.buffer = []
+
+    def on_end(self, name):
+        if self.depth == 2 and self.current is not None:
+            self.texts[self.current] = ''.join(self.buffer)
+            self.current = None
+        self.depth -= 1
+
+    def on_data(self, data):
+        if self.depth == 2 and self.current is not None:
+            self.buffer.append(data)
 
 
 # XML message format:
@@ -62,87 +138,49 @@ class JSONParamsParser(XmlParserHelper):
 #           JSON_PARAMS
 #       </params>
 #   </event>
-class XmlMessageParser(AbstractMessageParser, XmlParserHelper):
+class XmlMessageParser(AbstractMessageParser):
+    FIELDS = ('id', 'token', 'catgory', 'service', 'params')
+
     def parse(self, xml_doc):
         try:
-            doc = parseString(xml_doc)
-
-            if not self.validate_xml(doc):
+            scanner = XmlScanner(self.FIELDS).scan(xml_doc)
+            if not self.validate_xml(scanner):
+                return None
+            texts = scanner.texts
+            if not texts['params'].strip():
+                # Params are decoded lazily, but a message without them is
+                # rejected here as it always was.
                 return None
-            root = doc.childNodes[0]
-            version = self.get_message_version(root)
-            eid = self.get_event_id(root)
-            category = self.get_category(root)
-            service = self.get_service(root)
-            token = self.get_token(root)
-
-            params_parser = JSONParamsParser()
-            params_parser.set_params_node(root.getElementsByTagName('params')[0])
-            params_parser.parse()
-            params = params_parser.params
-
-            return Event(eid, category, service, token, params, version)
+            event = Event(texts['id'], texts['catgory'], texts['service'], texts['token'],
+                          None, scanner.attrs['version'])
+            event.set_raw_params(texts['params'].encode('utf-8'))
+            return event
         except Exception:
             # if got any exception in parse return None
             return None
 
-    def validate_xml(self, doc):
-        root = doc.childNodes[0]
-        if not root.tagName == 'event':
+    def validate_xml(self, scanner):
+        if not scanner.root == 'event':
             return False
-        if not root.hasAttribute('version'):
+        if 'version' not in scanner.attrs:
             return False
         return True
 
     def validate_token(self, token):
-        if self.generate_token() == token:
-            return True
-        elif self.generate_token("prev") == token:
-            return True
-        elif self.generate_token("next") == token:
-            return True
-        return False
-
-    def get_message_version(self, root):
-        return root.getAttribute('version')
-
-    def get_event_id(self, root):
-        node = root.getElementsByTagName('id')[0]
-        return self.get_text(node)
-
-    def get_category(self, root):
-        node = root.getElementsByTagName('catgory')[0]
-        return self.get_text(node)
+        return self.configuration.token_cache.validate(token)
 
-    def get_service(self, root):
-        node = root.getElementsByTagName('service')[0]
-        return self.get_text(node)
 
-    def get_token(self, root):
-        node = root.getElementsByTagName('token')[0]
-        return self.get_text(node)
+class XmlResponseParser(object):
+    FIELDS = ('id', 'message')
 
-
-class XmlResponseParser(XmlParserHelper):
     def parse(self, xml_doc):
         try:
-            doc = parseString(xml_doc)
-            root = doc.childNodes[0]
-            rid = self.get_request_id(root)
-            message = self.get_message(root)
-            return (rid, message)
+            texts = XmlScanner(self.FIELDS).scan(xml_doc).texts
+            return (texts['id'], texts['message'])
         except Exception:
             # if got any exception in parse return None
             return None
 
-    def get_request_id(self, root):
-        node = root.getElementsByTagName('id')[0]
-        return self.get_text(node)
-
-    def get_message(self, root):
-        node = root.getElementsByTagName('message')[0]
-        return self.get_text(node)
-
 
 ID_SEED = 0
 MESSAGE_TEMPLATE = """<?xml version="1.0"?>
@@ -162,6 +200,12 @@ REPORT_XML_TEMPLATE = """<?xml version="1.0"?>
 """
 
 
+def next_event_id():
+    global ID_SEED
+    ID_SEED = ID_SEED + 1
+    return ID_SEED
+
+
 class XmlRequestGenerator(object):
     def __init__(self, configuration, category, service, message):
         self.message = message
@@ -171,15 +215,20 @@ class XmlRequestGenerator(object):
         self.message = message
 
     def generate_id(self):
-        global ID_SEED
-        ID_SEED = ID_SEED + 1
-        return ID_SEED
+        return next_event_id()
 
     def generate_token(self):
-        return do_generate_token(self.configuration)
+        return self.configuration.token_cache.current_token()
 
     def encode_params(self):
-        return json.dumps(self.message)
+        if isinstance(self.message, memoryview):
+            # Params already in JSON, e.g. from Request.get_raw_params.
+            params = self.message.tobytes().decode('utf-8')
+        else:
+            params = json.dumps(self.message)
+        # "]]>" can only be in a JSON string, escape it so it does not end
+        # the CDATA section.
+        return params.replace(']]>', ']]\\u003e')
 
     def to_xml(self):
         return MESSAGE_TEMPLATE % (
@@ -25,3 +25,4 @@ from servicebus.pika.adapters import SelectConnection
 from servicebus.pika.adapters import TornadoConnection
 from servicebus.pika.adapters import TwistedConnection
 from servicebus.pika.adapters import LibevConnection
+from servicebus.pika.adapters import AsyncioConnection
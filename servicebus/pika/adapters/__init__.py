@@ -14,6 +14,8 @@ Pika provides multiple adapters to connect to RabbitMQ:
   with the Twisted framework
 - adapters.libev_connection.LibevConnection: Connection adapter for use
   with the libev event loop and employing nonblocking IO
+- adapters.asyncio_connection.AsyncioConnection: Connection adapter for use
+  with the asyncio event loop
 
 """
 from servicebus.pika.adapters.base_connection import BaseConnection
@@ -39,3 +41,8 @@ try:
     from servicebus.pika.adapters.libev_connection import LibevConnection
 except ImportError:
     LibevConnection = None
+
+try:
+    from servicebus.pika.adapters.asyncio_connection import AsyncioConnection
+except ImportError:
+    AsyncioConnection = None
@@ -0,0 +1,186 @@
+"""Use pika with the asyncio event loop"""
+import asyncio
+import logging
+
+from servicebus.pika.adapters import base_connection
+
+LOGGER = logging.getLogger(__name__)
+
+
+class IOLoopAdapter(object):
+    """Expose the subset of the pika IOLoop interface used by BaseConnection
+    on top of an asyncio event loop.
+
+    :param asyncio.AbstractEventLoop loop: The asyncio event loop
+
+    """
+    READ = base_connection.BaseConnection.READ
+    WRITE = base_connection.BaseConnection.WRITE
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handlers = {}
+        self.readers = set()
+        self.writers = set()
+
+    def add_timeout(self, deadline, callback_method):
+        """Add the callback_method to the event loop to fire after deadline
+        seconds. Returns a handle to the timeout.
+
+        :param int deadline: The number of seconds to wait to call callback
+        :param method callback_method: The callback method
+        :rtype: asyncio.TimerHandle
+
+        """
+        return self.loop.call_later(deadline, callback_method)
+
+    def remove_timeout(self, timeout_id):
+        """Cancel the timeout returned from add_timeout.
+
+        :param asyncio.TimerHandle timeout_id: The timeout handle
+
+        """
+        timeout_id.cancel()
+
+    def add_handler(self, fd, handler, events):
+        """Start watching fd for the given events.
+
+        :param int fd: The file descriptor
+        :param method handler: Called with (fd, events) when fd is ready
+        :param int events: READ and/or WRITE bitmask
+
+        """
+        self.handlers[fd] = handler
+        self.update_handler(fd, events)
+
+    def update_handler(self, fd, events):
+        """Change the events watched for fd.
+
+        :param int fd: The file descriptor
+        :param int events: READ and/or WRITE bitmask
+
+        """
+        handler = self.handlers[fd]
+        if events & self.READ:
+            if fd not in self.readers:
+                self.loop.add_reader(fd, handler, fd, self.READ)
+                self.readers.add(fd)
+        elif fd in self.readers:
+            self.loop.remove_reader(fd)
+            self.readers.discard(fd)
+
+        if events & self.WRITE:
+            if fd not in self.writers:
+                self.loop.add_writer(fd, handler, fd, self.WRITE)
+                self.writers.add(fd)
+        elif fd in self.writers:
+            self.loop.remove_writer(fd)
+            self.writers.discard(fd)
+
+    def remove_handler(self, fd):
+        """Stop watching fd.
+
+        :param int fd: The file descriptor
+
+        """
+        if fd in self.readers:
+            self.loop.remove_reader(fd)
+            self.readers.discard(fd)
+        if fd in self.writers:
+            self.loop.remove_writer(fd)
+            self.writers.discard(fd)
+        self.handlers.pop(fd, None)
+
+    def stop(self):
+        """Stop the event loop"""
+        self.loop.stop()
+
+    def close(self):
+        """The event loop is owned by the application, do not close it"""
+        pass
+
+
+class AsyncioConnection(base_connection.BaseConnection):
+    """The AsyncioConnection runs on an asyncio event loop. The event loop
+    belongs to the application, so stop_ioloop_on_close defaults to False.
+
+    :param pika.connection.Parameters parameters: Connection parameters
+    :param on_open_callback: The method to call when the connection is open
+    :type on_open_callback: method
+    :param on_open_error_callback: Method to call if the connection cant
+                                   be opened
+    :type on_open_error_callback: method
+    :param bool stop_ioloop_on_close: Call loop.stop() if disconnected
+    :param custom_ioloop: Override using asyncio.get_event_loop()
+
+    """
+
+    def __init__(self,
+                 parameters=None,
+                 on_open_callback=None,
+                 on_open_error_callback=None,
+                 on_close_callback=None,
+                 stop_ioloop_on_close=False,
+                 custom_ioloop=None):
+        """Create a new instance of the AsyncioConnection class, connecting
+        to RabbitMQ automatically
+
+        :param pika.connection.Parameters parameters: Connection parameters
+        :param on_open_callback: The method to call when the connection is open
+        :type on_open_callback: method
+        :param on_open_error_callback: Method to call if the connection cant
+                                       be opened
+        :type on_open_error_callback: method
+        :param bool stop_ioloop_on_close: Call loop.stop() if disconnected
+        :param custom_ioloop: Override using asyncio.get_event_loop()
+
+        """
+        self.ioloop = IOLoopAdapter(custom_ioloop or asyncio.get_event_loop())
+        super(AsyncioConnection, self).__init__(parameters, on_open_callback,
+                                                on_open_error_callback,
+                                                on_close_callback, self.ioloop,
+                                                stop_ioloop_on_close)
+
+    def connect(self):
+        """Connect to RabbitMQ without blocking the event loop. Address
+        lookup and socket connect run in the loop's default executor, the
+        connection continues on the event loop once the socket is connected.
+
+        """
+        self._set_connection_state(self.CONNECTION_INIT)
+        future = self.ioloop.loop.run_in_executor(
+            None, super(AsyncioConnection, self)._adapter_connect)
+        future.add_done_callback(self._on_adapter_connected)
+
+    def _on_adapter_connected(self, future):
+        """Invoked on the event loop when the socket connect finished. Retry
+        or report the error the same way as Connection.connect.
+
+        :param asyncio.Future future: Result of BaseConnection._adapter_connect
+
+        """
+        try:
+            error = future.result()
+        except Exception as exc:
+            error = exc
+        if not error:
+            self.ioloop.add_handler(self.socket.fileno(), self._handle_events,
+                                    self.event_state)
+            return self._on_connected()
+        self.remaining_connection_attempts -= 1
+        LOGGER.warning('Could not connect, %i attempts left',
+                       self.remaining_connection_attempts)
+        if self.remaining_connection_attempts:
+            LOGGER.debug('Retrying in %i seconds', self.params.retry_delay)
+            self.add_timeout(self.params.retry_delay, self.connect)
+        else:
+            self.callbacks.process(0, self.ON_CONNECTION_ERROR, self, self,
+                                   error)
+            self.remaining_connection_attempts = self.params.connection_attempts
+            self._set_connection_state(self.CONNECTION_CLOSED)
+
+    def _adapter_disconnect(self):
+        """Disconnect from the RabbitMQ broker"""
+        if self.socket:
+            self.ioloop.remove_handler(self.socket.fileno())
+        super(AsyncioConnection, self)._adapter_disconnect()
@@ -2124,11 +2124,18 @@ class BlockingChannel(object):  # pylint: disable=R0904,R0902
         self._impl.basic_reject(delivery_tag=delivery_tag, requeue=requeue)
         self._flush_output()
 
-    def confirm_delivery(self):
+    def confirm_delivery(self, callback=None):
         """Turn on RabbitMQ-proprietary Confirm mode in the channel.
 
         For more information see:
             http://www.rabbitmq.com/extensions.html#confirms
+
+        :param method callback: (py-servicebus) Called with the Basic.Ack or
+            Basic.Nack method frame of every confirmation. Publish does not
+            wait for confirmation then, the caller tracks delivery tags and
+            drives `BlockingConnection.process_data_events`. The callback is
+            invoked from within connection I/O, so it must not call methods
+            of this channel or its connection.
         """
         if self._delivery_confirmation:
             LOGGER.error('confirm_delivery: confirmation was already enabled '
@@ -2141,11 +2148,16 @@ class BlockingChannel(object):  # pylint: disable=R0904,R0902
                                     one_shot=True)
 
             self._impl.confirm_delivery(
-                callback=self._message_confirmation_result.set_value_once,
+                callback=(callback or
+                          self._message_confirmation_result.set_value_once),
                 nowait=False)
 
             self._flush_output(select_ok_result.is_ready)
 
+        if callback is not None:
+            # Publish as in non-confirm mode, confirmations go to callback
+            return
+
         self._delivery_confirmation = True
 
         # Unroutable messages returned after this point will be in the context
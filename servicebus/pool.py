@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+
+
+DEFAULT_POOL_MAX_IDLE = 8
+# Below default heartbeat_interval, broker drops a connection which missed
+# heartbeats for about two intervals.
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+
+
+class ConnectionPool(object):
+    """
+    Pool of connected MessageSender keyed by RabbitMQ host.
+
+    acquire lends a sender to one user until it is given back by release,
+    so a sender is never used by two threads at the same time. Senders are
+    checked for health before reuse, at most max_idle senders are kept per
+    host and senders idle for more than idle_timeout seconds are closed.
+    """
+    def __init__(self, max_idle=DEFAULT_POOL_MAX_IDLE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+
+    def acquire(self, host, factory):
+        self.check_fork()
+        self.evict_idle()
+        while True:
+            with self.lock:
+                idle = self.idle.get(host, [])
+                if len(idle) == 0:
+                    break
+                caller, released_at = idle.pop()
+            if caller.is_healthy():
+                return caller
+            caller.safe_close()
+        caller = factory()
+        caller.ensure_connection()
+        return caller
+
+    def release(self, caller):
+        self.check_fork()
+        if not caller.is_healthy():
+            caller.safe_close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(caller.host, [])
+            if len(idle) < self.max_idle:
+                idle.append((caller, time.time()))
+                return
+        caller.safe_close()
+
+    def evict_idle(self):
+        expire_at = time.time() - self.idle_timeout
+        expired = []
+        with self.lock:
+            for host, idle in self.idle.items():
+                alive = []
+                for caller, released_at in idle:
+                    if released_at < expire_at:
+                        expired.append(caller)
+                    else:
+                        alive.append((caller, released_at))
+                self.idle[host] = alive
+        for caller in expired:
+            caller.safe_close()
+
+    def check_fork(self):
+        # Connections inherited from parent process must not be used by
+        # child, just forget them.
+        if self.pid != os.getpid():
+            with self.lock:
+                self.idle = {}
+                self.pid = os.getpid()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for callers in idle.values():
+            for caller, released_at in callers:
+                caller.safe_close()
@@ -2,6 +2,8 @@ import logging
 import threading
 from servicebus.parser import XmlMessageParser, XmlResponseGenerator
 from servicebus.message import AbstractReceiver
+from servicebus.dispatch import EventDispatcher
+from servicebus.message import STREAM_SEQ_HEADER, STREAM_END_HEADER, STREAM_ERROR_HEADER
 from servicebus.request import Request
 
 
@@ -18,8 +20,28 @@ class RPCResponse(object):
         self.receiver.response_message(self.channel, self.method, self.header,
                                        msg.to_xml())
 
+    def stream(self, chunks):
+        """
+        Send each item of chunks as one response message as soon as it is
+        produced, then an end marker. Caller reads them by Sender.call_stream.
+        """
+        seq = 0
+        end_msg = XmlResponseGenerator(self.event.id, "")
+        try:
+            for chunk in chunks:
+                msg = XmlResponseGenerator(self.event.id, chunk)
+                self.receiver.response_message(self.channel, self.method, self.header,
+                                               msg.to_xml(), {STREAM_SEQ_HEADER: str(seq)})
+                seq += 1
+        except Exception as e:
+            self.receiver.response_message(self.channel, self.method, self.header,
+                                           end_msg.to_xml(), {STREAM_ERROR_HEADER: str(e)})
+            raise e
+        self.receiver.response_message(self.channel, self.method, self.header,
+                                       end_msg.to_xml(), {STREAM_END_HEADER: str(seq)})
+
 
-class MessageBusReceiver(AbstractReceiver):
+class MessageBusReceiver(AbstractReceiver, EventDispatcher):
     def get_message_parser(self):
         return self.message_parser
 
@@ -29,38 +51,22 @@ class MessageBusReceiver(AbstractReceiver):
         self.message_parser.set_configuration(service_bus.configuration)
 
     def on_rpc(self, channel, method, header, body):
-        event = self.message_parser.parse(body)
-        if not self.message_parser.validate_token(event.token):
-            logging.error('Token Error')
-            msg = XmlResponseGenerator(event.id, "Token not valid!")
-            self.response_message(channel, method, header, msg.to_xml())
-            return
+        self.dispatch_rpc(header, body, channel, method)
 
-        response = RPCResponse(event, channel, method, header, self)
-        request = Request(event, self)
-        service = self.service_bus.lookup_rpc_service_thread(event.category, event.service)
+    def on_message(self, channel, method, header, body):
+        self.dispatch_message(header, body)
 
-        if service is None:
-            error_msg = 'Cannot Find RPC Service: %s.%s' % (event.category, event.service)
-            logging.error(error_msg)
-            msg = XmlResponseGenerator(event.id, error_msg)
-            self.response_message(channel, method, header, msg.to_xml())
-        else:
-            logging.info("Call RPC Service %s.%s" % (event.category, event.service))
-            service.on_call(request, response)
+    def lookup_rpc_service(self, category, name):
+        return self.service_bus.lookup_rpc_service_thread(category, name)
 
-    def on_message(self, channel, method, header, body):
-        event = self.message_parser.parse(body)
-        if not self.message_parser.validate_token(event.token):
-            logging.error('Token Error')
-            return
+    def lookup_message_service(self, category, name):
+        return self.service_bus.lookup_message_service_thread(category, name)
 
-        request = Request(event, self)
-        service = self.service_bus.lookup_message_service_thread(event.category, event.service)
+    def call_rpc_service(self, channel, method, service, event, header):
+        response = RPCResponse(event, channel, method, header, self)
+        request = Request(event, self, self.service_bus.shared_sender)
+        service.on_call(request, response)
 
-        if service is None:
-            error_msg = 'Cannot Find Message Service: %s.%s' % (event.category, event.service)
-            logging.error(error_msg)
-        else:
-            logging.info("Call Message Service %s.%s" % (event.category, event.service))
-            service.on_message(request)
+    def call_message_service(self, service, event, header):
+        request = Request(event, self, self.service_bus.shared_sender)
+        service.on_message(request)
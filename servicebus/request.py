@@ -1,17 +1,33 @@
 from servicebus.sender import Sender
+from servicebus.message import is_expired
 
 
 class Request(object):
-    def __init__(self, event, receiver):
+    def __init__(self, event, receiver, sender=None):
         self.event = event
         self.receiver = receiver
-        self.sender = Sender(receiver.service_bus.configuration)
+        self.sender = sender
+        # A shared sender is owned by someone else, never close it here.
+        self.own_sender = sender is None
 
     def get_params(self):
         return self.event.params
 
+    def get_raw_params(self):
+        return self.event.get_raw_params()
+
     def get_event(self):
         return self.event
 
+    def is_expired(self):
+        return is_expired(self.event.deadline)
+
     def get_sender(self):
+        if self.sender is None:
+            self.sender = Sender(self.receiver.service_bus.configuration)
         return self.sender
+
+    def close(self):
+        if self.own_sender and self.sender is not None:
+            self.sender.close()
+            self.sender = None
@@ -0,0 +1,170 @@
+import sys
+import time
+import uuid
+import heapq
+import logging
+from threading import Thread
+from servicebus.future import Future
+from servicebus.message import TimeoutException, decode_body
+
+if sys.version_info < (3, 0):
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+# Max seconds I/O thread blocks in broker I/O while calls are in flight.
+POLL_INTERVAL = 0.01
+# Max seconds I/O thread waits for new calls when nothing is in flight.
+IDLE_WAIT = 1
+
+
+class RPCClient(Thread):
+    """
+    Multiplex many RPC calls and sends on one MessageSender connection.
+
+    The connection is owned by a background I/O thread, so any thread can
+    use the client. Callers put requests into a queue and get a Future
+    back. All responses are received by one consumer of the caller's reply
+    queue and matched by correlation id.
+    Deadlines of all in flight calls are kept in one heap.
+    """
+    def __init__(self, caller):
+        super(RPCClient, self).__init__()
+        self.daemon = True
+        self.caller = caller
+        self.requests = Queue()
+        self.pending = {}
+        self.deadlines = []
+        self.running = True
+
+    def call(self, target, msg, timeout=300):
+        return self.submit(self.publish, target, msg, timeout)
+
+    def send(self, target, msg, ttl=None):
+        """
+        Publish a message without response. Future's result is None once
+        the message is published by the I/O thread.
+        """
+        return self.submit(self.publish_message, target, msg, ttl)
+
+    def submit(self, method, *args):
+        # method runs in I/O thread as method(future, *args).
+        future = Future()
+        if not self.running:
+            future.set_exception(Exception("RPC client closed"))
+            return future
+        self.requests.put((method, args, future))
+        return future
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)
+
+    def run(self):
+        error = Exception("RPC client closed")
+        try:
+            self.caller.ensure_connection()
+            self.caller.ensure_callback_queue(self.on_response)
+            while self.running:
+                self.process_requests()
+                self.process_data_events()
+                self.expire_calls()
+        except Exception as e:
+            logging.exception(e)
+            error = e
+        finally:
+            self.running = False
+            try:
+                self.caller.close()
+            except Exception:
+                pass
+            self.fail_all(error)
+
+    def process_requests(self):
+        block = len(self.pending) == 0
+        while self.running:
+            try:
+                if block:
+                    request = self.requests.get(timeout=IDLE_WAIT)
+                    block = False
+                else:
+                    request = self.requests.get_nowait()
+            except Empty:
+                return
+            if request is None:
+                return
+            method, args, future = request
+            method(future, *args)
+
+    def publish(self, future, target, msg, timeout):
+        corr_id = str(uuid.uuid4())
+        self.pending[corr_id] = future
+        heapq.heappush(self.deadlines, (time.time() + timeout, corr_id))
+        try:
+            body, properties = self.caller.build_message(
+                msg,
+                timeout,
+                reply_to=self.caller.callback_queue,
+                correlation_id=corr_id,
+            )
+            self.caller.channel.basic_publish(
+                exchange=self.caller.exchange_name,
+                routing_key=str(target),
+                properties=properties,
+                body=body)
+        except Exception as e:
+            self.pending.pop(corr_id, None)
+            future.set_exception(e)
+            raise e
+
+    def publish_message(self, future, target, msg, ttl):
+        try:
+            body, properties = self.caller.build_message(msg, ttl)
+            self.caller.channel.basic_publish(
+                exchange=self.caller.exchange_name,
+                routing_key=str(target),
+                properties=properties,
+                body=body)
+        except Exception as e:
+            future.set_exception(e)
+            raise e
+        future.set_result(None)
+
+    def process_data_events(self):
+        time_limit = 0
+        if len(self.pending) > 0:
+            time_limit = POLL_INTERVAL
+            if len(self.deadlines) > 0:
+                time_limit = min(time_limit, max(0, self.deadlines[0][0] - time.time()))
+        self.caller.connection.process_data_events(time_limit)
+
+    def on_response(self, ch, method, props, body):
+        future = self.pending.pop(props.correlation_id, None)
+        if future is not None:
+            future.set_result(decode_body(body, props))
+
+    def expire_calls(self):
+        now = time.time()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            deadline, corr_id = heapq.heappop(self.deadlines)
+            future = self.pending.pop(corr_id, None)
+            if future is not None:
+                future.set_exception(TimeoutException("Timeout"))
+        if len(self.pending) == 0:
+            # Responses of all deadlines left are received, forget them.
+            self.deadlines = []
+
+    def fail_all(self, error):
+        pending = list(self.pending.values())
+        self.pending = {}
+        self.deadlines = []
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except Empty:
+                break
+            if request is not None:
+                pending.append(request[2])
+        for future in pending:
+            future.set_exception(error)
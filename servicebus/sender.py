@@ -1,20 +1,56 @@
+import time
 import logging
-from servicebus.parser import XmlRequestGenerator, XmlResponseParser
+import threading
+from threading import Thread
+from servicebus.rpc import RPCClient
+from servicebus.future import Future
+from servicebus.cache import make_key
+from servicebus.codec import get_codec
+from servicebus.message import TimeoutException, DEFAULT_STREAM_PREFETCH, is_broker_error
+from servicebus.parser import XmlResponseParser
+from servicebus.dispatch import is_error_reply
+
+
+# Status of each target in Sender.call_many result
+CALL_OK = 'ok'
+CALL_TIMEOUT = 'timeout'
+CALL_ERROR = 'error'
+
+
+def parse_target(target):
+    parts = target.split(".")
+    if len(parts) != 3:
+        raise Exception("Target not validate")
+    return parts
 
 
 class Sender(object):
-    def __init__(self, configuration, smart_route=True):
+    """
+    params: configuration
+            smart_route     choose host by health of target
+            thread_safe     call, call_async, call_many, send and ping go
+                            through one RPCClient I/O thread and one
+                            connection, so the Sender can be shared by
+                            threads. call_stream, send_many and probe_all
+                            use connections of their own for each call
+    """
+    def __init__(self, configuration, smart_route=True, thread_safe=False):
         self.configuration = configuration
         self.exchange_name = configuration.exchange_name
         self.caller = None
         self.callers = None
         self.smart_route = smart_route
+        self.thread_safe = thread_safe
+        self.rpc_client = None
+        self.response_cache = None
+        self.lock = threading.RLock()
 
     def get_caller(self, reverse=False):
-        if self.caller is None:
-            self.caller = self.configuration.create_sender(reverse)
-            self.caller.set_exchange(self.exchange_name)
-        return self.caller
+        with self.lock:
+            if self.caller is None:
+                self.caller = self.configuration.create_sender(reverse)
+                self.caller.set_exchange(self.exchange_name)
+            return self.caller
 
     def choose_caller(self, target, reverse=False):
         if self.smart_route:
@@ -29,80 +65,333 @@ class Sender(object):
         callers = self.get_callers()
         if reverse:
             callers.reverse()
+        callers = self.configuration.host_selector.sort(callers, lambda caller: caller.host)
         ret = None
+        health_cache = self.configuration.health_cache
         for caller in callers:
-            if self._caller_ping(caller, target):
+            healthy = health_cache.get(caller.host, target)
+            if healthy is None:
+                healthy = self._caller_ping(caller, target)
+            if healthy:
                 return caller
         if len(callers) > 0:
             return callers[0]
         return ret
 
     def _caller_ping(self, caller, target, timeout=3):
+        start = time.time()
+        error = None
         try:
             ret = caller.call(target, "PING", timeout)
-            return ret == "PONG"
-        except Exception:
-            return False
+            healthy = ret == "PONG"
+        except Exception as e:
+            healthy = False
+            error = e
+        self.record_call(caller, target, healthy, time.time() - start, error)
+        return healthy
+
+    def mark_health(self, caller, target, healthy):
+        self.configuration.health_cache.mark(caller.host, target, healthy)
+
+    def record_call(self, caller, target, healthy, latency, error=None):
+        # A dead or slow target only makes target unhealthy through this
+        # host, host selector counts errors of the broker itself.
+        self.mark_health(caller, target, healthy)
+        if healthy:
+            self.configuration.host_selector.record_success(caller.host, latency)
+        elif error is not None and is_broker_error(error):
+            self.configuration.host_selector.record_failure(caller.host)
 
     def get_callers(self):
-        if self.callers is None:
-            self.callers = self.configuration.create_senders()
-            for caller in self.callers:
+        with self.lock:
+            # Empty list means no host was reachable, try again next time.
+            if not self.callers:
+                self.callers = self.configuration.create_senders()
+                for caller in self.callers:
+                    caller.set_exchange(self.exchange_name)
+            return self.callers
+
+    def set_response_cache(self, response_cache):
+        # Responses of call will be cached in this ResponseCache.
+        self.response_cache = response_cache
+
+    def get_rpc_client(self):
+        with self.lock:
+            if self.rpc_client is None or not self.rpc_client.is_alive():
+                caller = self.configuration.create_sender()
                 caller.set_exchange(self.exchange_name)
-        return self.callers
+                self.rpc_client = RPCClient(caller)
+                self.rpc_client.start()
+            return self.rpc_client
 
     def parse_target(self, target):
-        parts = target.split(".")
-        if len(parts) != 3:
-            raise Exception("Target not validate")
-        return parts
+        return parse_target(target)
+
+    def encode_request(self, category, service, params):
+        return self.configuration.message_codec.encode(self.configuration, category, service, params)
 
     def ping(self, target, timeout=3):
+        if self.thread_safe:
+            return self.get_rpc_client().call(target, "PING", timeout).result() == "PONG"
         caller = self.get_caller(True)
         ret = caller.call(target, "PING", timeout)
         return ret == "PONG"
 
-    def ping_all(self, target, timeout=3):
-        callers = self.get_callers()
-        total = len(callers)
-        success = 0
-        for caller in callers:
-            try:
+    def probe_all(self, target, timeout=3):
+        """
+        PING target through all hosts at the same time. Return a list of
+        (host, success, latency) tuples, latency is in seconds.
+        """
+        if self.thread_safe:
+            callers = self.configuration.create_senders()
+            for caller in callers:
                 caller.set_exchange(self.exchange_name)
+            try:
+                return self.probe_callers(callers, target, timeout)
+            finally:
+                for caller in callers:
+                    self.configuration.release_sender(caller)
+        return self.probe_callers(self.get_callers(), target, timeout)
+
+    def probe_callers(self, callers, target, timeout):
+        results = [None] * len(callers)
+        errors = [None] * len(callers)
+
+        def probe(i, caller):
+            start = time.time()
+            try:
                 ret = caller.call(target, "PING", timeout)
-                if ret == "PONG":
-                    success += 1
-            except Exception:
-                pass
-        return success, total
+                healthy = ret == "PONG"
+            except Exception as e:
+                healthy = False
+                errors[i] = e
+            results[i] = (caller.host, healthy, time.time() - start)
+
+        threads = []
+        for i, caller in enumerate(callers):
+            thread = Thread(target=probe, args=(i, caller))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for caller, (host, healthy, latency), error in zip(callers, results, errors):
+            self.record_call(caller, target, healthy, latency, error)
+        return results
+
+    def ping_all(self, target, timeout=3):
+        results = self.probe_all(target, timeout)
+        success = len([ret for ret in results if ret[1]])
+        return success, len(results)
 
     def call(self, target, params, timeout=300, reverse=False):
+        if self.response_cache is not None:
+            hit, ret = self.response_cache.get(target, params)
+            if hit:
+                return ret
+        single_flight = self.configuration.single_flight
+        if single_flight is not None:
+            ret = single_flight.do(make_key(target, params), timeout, self.do_call, target, params, timeout, reverse)
+        else:
+            ret = self.do_call(target, params, timeout, reverse)
+        # Error reply may be gone after a deploy or token rollover.
+        if self.response_cache is not None and ret is not None and not is_error_reply(ret):
+            self.response_cache.put(target, params, ret)
+        return ret
+
+    def do_call(self, target, params, timeout=300, reverse=False):
+        if self.thread_safe:
+            return self.call_async(target, params, timeout).result()
         target, category, service = self.parse_target(target)
         caller = self.choose_caller(target, reverse)
         if caller is None:
             raise Exception("Cannot connect to %s" % target)
-        req_msg = XmlRequestGenerator(self.configuration, category, service, params)
-        ret = caller.call(target, req_msg.to_xml(), timeout)
+        msg = self.encode_request(category, service, params)
+        start = time.time()
+        try:
+            ret = caller.call(target, msg, timeout)
+        except Exception as e:
+            self.record_call(caller, target, False, time.time() - start, e)
+            raise e
+        self.record_call(caller, target, True, time.time() - start)
         resp_parser = XmlResponseParser()
         return resp_parser.parse(ret)
 
-    def send(self, target, params):
+    def call_stream(self, target, params, timeout=300, prefetch=DEFAULT_STREAM_PREFETCH):
+        """
+        Call a service which replies by RPCResponse.stream. Return an
+        iterator of (event id, chunk). timeout is max seconds to wait for
+        each chunk, prefetch is max chunks buffered in this process.
+        """
         target, category, service = self.parse_target(target)
+        msg = self.encode_request(category, service, params)
+        if self.thread_safe:
+            return self.call_stream_own_caller(target, msg, timeout, prefetch)
         caller = self.choose_caller(target)
         if caller is None:
             raise Exception("Cannot connect to %s" % target)
-        req_msg = XmlRequestGenerator(self.configuration, category, service, params)
-        caller.send(target, req_msg.to_xml())
+        chunks = caller.call_stream(target, msg, timeout, prefetch)
+        resp_parser = XmlResponseParser()
+        return (resp_parser.parse(chunk) for chunk in chunks)
+
+    def call_stream_own_caller(self, target, msg, timeout, prefetch):
+        caller = self.create_own_caller()
+        try:
+            resp_parser = XmlResponseParser()
+            for chunk in caller.call_stream(target, msg, timeout, prefetch):
+                yield resp_parser.parse(chunk)
+        finally:
+            self.configuration.release_sender(caller)
+
+    def create_own_caller(self):
+        # Caller used by one thread only, give it back by release_sender.
+        caller = self.configuration.create_sender()
+        caller.set_exchange(self.exchange_name)
+        return caller
+
+    def call_async(self, target, params, timeout=300):
+        """
+        Send RPC call and return a Future without waiting for response.
+        All async calls share one connection and one reply consumer.
+        Future's result is same as call's return value.
+        """
+        target, category, service = self.parse_target(target)
+        msg = self.encode_request(category, service, params)
+        future = self.get_rpc_client().call(target, msg, timeout)
+        resp_parser = XmlResponseParser()
+        return future.then(resp_parser.parse)
+
+    def call_many(self, targets, params, timeout=300):
+        """
+        Scatter-gather RPC. Publish same call to all targets at once and
+        collect responses until all arrived or timeout is reached. Return
+        a dict of target -> (status, result). status is CALL_OK with call's
+        return value, CALL_TIMEOUT with None or CALL_ERROR with exception.
+        """
+        futures = []
+        for target in targets:
+            try:
+                future = self.call_async(target, params, timeout)
+            except Exception as e:
+                logging.exception(e)
+                future = Future()
+                future.set_exception(e)
+            futures.append((target, future))
+
+        deadline = time.time() + timeout
+        results = {}
+        for target, future in futures:
+            if not future.wait(max(0, deadline - time.time())):
+                results[target] = (CALL_TIMEOUT, None)
+                continue
+            error = future.exception()
+            if error is None:
+                results[target] = (CALL_OK, future.result())
+            elif isinstance(error, TimeoutException):
+                results[target] = (CALL_TIMEOUT, None)
+            else:
+                results[target] = (CALL_ERROR, error)
+        return results
+
+    def send(self, target, params, ttl=None):
+        target, category, service = self.parse_target(target)
+        if self.configuration.batcher is not None and ttl is None:
+            # Events in a batch are always in binary format.
+            msg = get_codec('binary').encode(self.configuration, category, service, params)
+            self.configuration.batcher.add(target, msg)
+            return
+        msg = self.encode_request(category, service, params)
+        configuration = self.configuration
+        if configuration.spool is not None and configuration.host_selector.all_down(configuration.hosts):
+            # Connecting to every host would block up to socket_timeout for
+            # each, spool drainer reconnects in background.
+            configuration.spool_message(target, msg)
+            return
+        if self.thread_safe:
+            self.send_thread_safe(target, msg, ttl)
+            return
+        try:
+            caller = self.choose_caller(target)
+        except Exception as e:
+            if self.configuration.spool is None:
+                raise e
+            logging.exception(e)
+            caller = None
+        if caller is None:
+            if self.configuration.spool is None:
+                raise Exception("Cannot connect to %s" % target)
+            # Spooled message is replayed without ttl, it may be sent long
+            # after the caller gave up.
+            self.configuration.spool_message(target, msg)
+            return
+        start = time.time()
+        try:
+            caller.send(target, msg, ttl)
+        except Exception as e:
+            self.record_call(caller, target, False, time.time() - start, e)
+            if self.configuration.spool is None:
+                raise e
+            logging.exception(e)
+            self.configuration.spool_message(target, msg)
+            return
+        # Publish success says nothing about target node, so only the
+        # host's latency is recorded.
+        self.configuration.host_selector.record_success(caller.host, time.time() - start)
+
+    def send_thread_safe(self, target, msg, ttl=None):
+        try:
+            self.get_rpc_client().send(target, msg, ttl).result()
+        except Exception as e:
+            if self.configuration.spool is None:
+                raise e
+            logging.exception(e)
+            self.configuration.spool_message(target, msg)
+
+    def send_many(self, messages, timeout=30):
+        """
+        Send a list of (target, params) with pipelined publisher confirms.
+        Messages to same node share one channel. Return a list of True or
+        False, one for each message.
+        """
+        nodes = {}
+        for i, (target, params) in enumerate(messages):
+            target, category, service = self.parse_target(target)
+            msg = self.encode_request(category, service, params)
+            nodes.setdefault(target, []).append((i, msg))
+
+        results = [False] * len(messages)
+        for target, items in nodes.items():
+            if self.thread_safe:
+                caller = self.create_own_caller()
+            else:
+                caller = self.choose_caller(target)
+                if caller is None:
+                    raise Exception("Cannot connect to %s" % target)
+            try:
+                rets = caller.send_many([(target, msg) for i, msg in items], timeout)
+            finally:
+                if self.thread_safe:
+                    self.configuration.release_sender(caller)
+            for (i, msg), ret in zip(items, rets):
+                results[i] = ret
+        return results
 
     def close(self):
-        if self.caller:
-            self.caller.close()
-            self.caller = None
-
-        if self.callers:
-            for caller in self.callers:
-                try:
-                    caller.close()
-                except Exception:
-                    pass
-            self.callers = None
+        with self.lock:
+            if self.rpc_client:
+                self.rpc_client.close()
+                self.rpc_client.join()
+                self.rpc_client = None
+
+            if self.caller:
+                self.configuration.release_sender(self.caller)
+                self.caller = None
+
+            if self.callers:
+                for caller in self.callers:
+                    try:
+                        self.configuration.release_sender(caller)
+                    except Exception:
+                        pass
+                self.callers = None
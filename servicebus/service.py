@@ -7,6 +7,7 @@ import asyncore
 from threading import Thread
 from multiprocessing import Process
 from servicebus import utils
+from servicebus.sender import Sender
 
 if sys.version_info < (3, 0):
     from Queue import Queue
@@ -25,6 +26,7 @@ class ServiceBus(object):
         self.after_fork_hook = None
         self.on_exit_hook = None
         self.queue_len = queue_len
+        self.shared_sender = None
 
     def after_fork(self):
         if self.after_fork_hook:
@@ -36,6 +38,16 @@ class ServiceBus(object):
     def set_on_exit_hook(self, hook):
         self.on_exit_hook = hook
 
+    def set_shared_sender(self, sender=None):
+        # Requests will use this long lived sender instead of creating and
+        # closing one for each message. It should be set after fork. All
+        # service threads use it at the same time, so it must be thread safe.
+        if sender is None:
+            sender = Sender(self.configuration, thread_safe=True)
+        elif not sender.thread_safe:
+            raise Exception("Shared sender should be created with thread_safe=True")
+        self.shared_sender = sender
+
     def set_node_name(self, name):
         self.node_name = name
 
@@ -47,6 +59,10 @@ class ServiceBus(object):
         key = "%s.%s" % (category, name)
         self.message_services[key] = service
 
+    def get_prefetch_count(self):
+        services = list(self.rpc_services.values()) + list(self.message_services.values())
+        return self.configuration.get_prefetch_count(services)
+
     def _prepare_message_service_threads(self):
         for key, service in self.message_services.items():
             thread = ServiceRunner(service, self.queue_len)
@@ -107,6 +123,7 @@ class ServiceBus(object):
                 logging.info('[Server %s]: Build Server' % host)
                 receiver = configuration.create_receiver(host)
                 receiver.set_service_bus(self)
+                receiver.set_prefetch_count(self.get_prefetch_count())
                 receiver.bind_queue_to_exchange(configuration.queue_name(), configuration.exchange_name)
                 logging.info('[Server %s]: Start Receive' % host)
                 self.running = receiver.start_receive()
@@ -187,7 +204,10 @@ class ServiceRunner(Thread):
 
     def run_service(self, service, msg_type, params):
         try:
-            if msg_type == "message":
+            if len(params) > 0 and params[0].is_expired():
+                # Request waited in queue until its caller gave up.
+                logging.warning("Drop expired %s request" % msg_type)
+            elif msg_type == "message":
                 service.on_message(*params)
             elif msg_type == "call":
                 service.on_call(*params)
@@ -196,7 +216,7 @@ class ServiceRunner(Thread):
 
         if len(params) > 0:
             request = params[0]
-            request.get_sender().close()
+            request.close()
 
     def on_message(self, request):
         self.queue.put(("message", (request,)))
@@ -0,0 +1,260 @@
+import os
+import json
+import zlib
+import time
+import struct
+import logging
+import threading
+from threading import Thread
+from servicebus.message import Envelope
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Record format: payload length and CRC32 of payload in 4 bytes big endian
+# unsigned integers, then payload. Payload is target, NUL, AMQP properties of
+# an Envelope in JSON (empty for plain message), NUL and message body.
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = '.spool'
+OFFSET_SUFFIX = '.offset'
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_FSYNC_BATCH = 100
+DEFAULT_FSYNC_INTERVAL = 1
+DEFAULT_DRAIN_INTERVAL = 5
+DRAIN_BATCH_SIZE = 1000
+
+
+def lock_file(fp):
+    # Return False if another process holds the lock.
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def encode_record(target, msg):
+    properties = b''
+    if isinstance(msg, Envelope):
+        properties = json.dumps(msg.properties).encode('utf-8')
+        msg = msg.body
+    if not isinstance(msg, bytes):
+        msg = msg.encode('utf-8')
+    payload = str(target).encode('utf-8') + b'\0' + properties + b'\0' + msg
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def read_records(fp):
+    """
+    Generator of (offset after record, target, msg) from a segment file.
+    Stop at a truncated or corrupted record, which is the tail of a write
+    interrupted by a crash.
+    """
+    offset = fp.tell()
+    while True:
+        header = fp.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = fp.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            logging.error("Spool record at %d is broken, skip rest of segment" % offset)
+            return
+        offset += RECORD_HEADER.size + length
+        target, properties, msg = payload.split(b'\0', 2)
+        if properties:
+            msg = Envelope(msg, **json.loads(properties.decode('utf-8')))
+        yield offset, target.decode('utf-8'), msg
+
+
+class Spool(object):
+    """
+    Append-only on disk queue of messages which cannot be sent because no
+    RabbitMQ host is reachable.
+
+    Each process appends to its own segment file and rolls to a new one when
+    segment_size is reached. Writes are fsync'ed every fsync_batch records or
+    fsync_interval seconds, so a crash may lose the last unsynced records.
+    drain replays sealed segments in order and deletes each one once all of
+    its records are sent.
+    """
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 fsync_batch=DEFAULT_FSYNC_BATCH, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.fp = None
+        self.counter = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def append(self, target, msg):
+        record = encode_record(target, msg)
+        with self.lock:
+            if self.fp is None or self.fp.tell() >= self.segment_size:
+                self._roll()
+            self.fp.write(record)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch or time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    def flush(self):
+        with self.lock:
+            if self.fp is not None:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            self._close_active()
+
+    def _roll(self):
+        self._close_active()
+        self.counter += 1
+        name = "%015d-%d-%06d%s" % (int(time.time() * 1000), os.getpid(), self.counter, SEGMENT_SUFFIX)
+        self.fp = open(os.path.join(self.directory, name), 'ab')
+        # Keep drainers of other processes away from the active segment.
+        lock_file(self.fp)
+
+    def _sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _close_active(self):
+        if self.fp is not None:
+            self._sync()
+            self.fp.close()
+            self.fp = None
+
+    def segments(self):
+        names = [name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def has_records(self):
+        for path in self.segments():
+            if os.path.getsize(path) > 0:
+                return True
+        return False
+
+    def drain(self, send_batch):
+        """
+        Replay spooled records. send_batch takes a list of (target, msg) and
+        returns a list of True or False for each of them. Stop on the first
+        failure and remember how far the segment was sent. Return number of
+        records sent.
+        """
+        with self.lock:
+            # Seal active segment, new records go to a new one.
+            self._close_active()
+            paths = self.segments()
+
+        sent = 0
+        for path in paths:
+            count, finished = self._drain_segment(path, send_batch)
+            sent += count
+            if not finished:
+                break
+        return sent
+
+    def _drain_segment(self, path, send_batch):
+        offset_path = path + OFFSET_SUFFIX
+        with open(path, 'rb') as fp:
+            if not lock_file(fp):
+                # Active segment of another process or drained by another one.
+                return 0, True
+            if os.path.exists(offset_path):
+                with open(offset_path) as ofp:
+                    fp.seek(int(ofp.read() or 0))
+
+            sent = 0
+            batch = []
+            offset = fp.tell()
+            for end, target, msg in read_records(fp):
+                batch.append((end, target, msg))
+                if len(batch) >= DRAIN_BATCH_SIZE:
+                    count, offset = self._send_batch(batch, offset, send_batch)
+                    sent += count
+                    if count < len(batch):
+                        self._save_offset(offset_path, offset)
+                        return sent, False
+                    batch = []
+            if len(batch) > 0:
+                count, offset = self._send_batch(batch, offset, send_batch)
+                sent += count
+                if count < len(batch):
+                    self._save_offset(offset_path, offset)
+                    return sent, False
+
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        return sent, True
+
+    def _send_batch(self, batch, offset, send_batch):
+        # Return count of records sent in order without failure and offset
+        # after the last of them.
+        try:
+            results = send_batch([(target, msg) for end, target, msg in batch])
+        except Exception as e:
+            logging.exception(e)
+            return 0, offset
+        count = 0
+        for (end, target, msg), ok in zip(batch, results):
+            if not ok:
+                break
+            count += 1
+            offset = end
+        return count, offset
+
+    def _save_offset(self, offset_path, offset):
+        with open(offset_path, 'w') as fp:
+            fp.write(str(offset))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+class SpoolDrainer(Thread):
+    """
+    Background thread which replays spooled messages once a RabbitMQ host
+    can be connected again.
+    """
+    def __init__(self, spool, configuration, interval=DEFAULT_DRAIN_INTERVAL):
+        super(SpoolDrainer, self).__init__()
+        self.daemon = True
+        self.spool = spool
+        self.configuration = configuration
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.spool.has_records():
+                    self.drain()
+            except Exception as e:
+                logging.exception(e)
+            self.stopped.wait(self.interval)
+
+    def drain(self):
+        caller = self.configuration.create_sender()
+        try:
+            caller.set_keep_alive(True)
+            caller.set_exchange(self.configuration.exchange_name)
+            sent = self.spool.drain(caller.send_many)
+            if sent > 0:
+                logging.info("Replayed %d spooled messages" % sent)
+        finally:
+            self.configuration.release_sender(caller)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,162 @@
+import time
+import threading
+import unittest
+from servicebus.configuration import Configuration
+from servicebus.codec import get_codec
+from servicebus.dispatch import EventDispatcher
+from servicebus.batch import Batcher, encode_batch, decode_batch, BATCH_CONTENT_TYPE
+
+CONFIG = Configuration({
+    'hosts': ['127.0.0.1'],
+    'user': 'guest',
+    'password': 'guest',
+    'node_name': 'TESTER-001',
+    'secret_token': 'secret token',
+})
+
+
+class FakeCaller(object):
+    def __init__(self, sent):
+        self.sent = sent
+
+    def set_keep_alive(self, keep_alive):
+        pass
+
+    def set_exchange(self, exchange_name):
+        pass
+
+    def send(self, target, msg):
+        self.sent.append((target, msg))
+
+
+class FakeConfiguration(object):
+    exchange_name = 'test'
+    spool = None
+
+    def __init__(self):
+        self.published = threading.Event()
+        self.sent = SentList(self.published)
+
+    def create_sender(self):
+        return FakeCaller(self.sent)
+
+    def release_sender(self, caller):
+        pass
+
+
+class SentList(list):
+    # List which signals when a batch is published.
+    def __init__(self, event):
+        super(SentList, self).__init__()
+        self.event = event
+
+    def append(self, item):
+        super(SentList, self).append(item)
+        self.event.set()
+
+
+def batch_messages(sent):
+    return [[msg.tobytes() for msg in decode_batch(envelope.body)] for target, envelope in sent]
+
+
+class BatchFormatTest(unittest.TestCase):
+    def test_round_trip(self):
+        messages = [b'first', b'', b'x' * 70000]
+        decoded = [msg.tobytes() for msg in decode_batch(encode_batch(messages))]
+        self.assertEqual(decoded, messages)
+        self.assertEqual(list(decode_batch(encode_batch([]))), [])
+
+    def test_truncated(self):
+        body = encode_batch([b'first', b'second'])
+        for size in (len(body) - 1, len(body) - len(b'second')):
+            self.assertRaises(Exception, list, decode_batch(body[:size]))
+        # Length prefix cut in the middle.
+        self.assertRaises(Exception, list, decode_batch(body[:len(body) - len(b'second') - 2]))
+
+
+class BatcherTest(unittest.TestCase):
+    def make_batcher(self, linger, max_size=100, max_bytes=1024 * 1024):
+        configuration = FakeConfiguration()
+        batcher = Batcher(configuration, linger, max_size, max_bytes)
+        self.addCleanup(batcher.close)
+        return batcher, configuration
+
+    def wait_published(self, configuration, count):
+        deadline = time.time() + 5
+        while len(configuration.sent) < count and time.time() < deadline:
+            configuration.published.wait(0.05)
+            configuration.published.clear()
+        self.assertEqual(len(configuration.sent), count)
+
+    def test_flush_on_size(self):
+        batcher, configuration = self.make_batcher(60, max_size=3)
+        for i in range(7):
+            batcher.add('node1', b'm%d' % i)
+        self.wait_published(configuration, 2)
+        self.assertEqual(batch_messages(configuration.sent), [[b'm0', b'm1', b'm2'], [b'm3', b'm4', b'm5']])
+        self.assertEqual(configuration.sent[0][1].properties['content_type'], BATCH_CONTENT_TYPE)
+
+    def test_flush_on_bytes(self):
+        batcher, configuration = self.make_batcher(60, max_bytes=10)
+        batcher.add('node1', b'12345')
+        batcher.add('node1', b'12345')
+        batcher.add('node1', b'1')
+        self.wait_published(configuration, 1)
+        self.assertEqual(batch_messages(configuration.sent), [[b'12345', b'12345']])
+
+    def test_flush_on_linger(self):
+        batcher, configuration = self.make_batcher(0.1)
+        start = time.time()
+        batcher.add('node1', b'first')
+        batcher.add('node2', b'second')
+        self.wait_published(configuration, 2)
+        self.assertTrue(time.time() - start >= 0.1)
+        targets = sorted(target for target, envelope in configuration.sent)
+        self.assertEqual(targets, ['node1', 'node2'])
+
+    def test_close_publishes_rest(self):
+        batcher, configuration = self.make_batcher(60)
+        batcher.add('node1', b'first')
+        batcher.close()
+        self.assertEqual(batch_messages(configuration.sent), [[b'first']])
+        self.assertRaises(Exception, batcher.add, 'node1', b'second')
+
+
+class Dispatcher(EventDispatcher):
+    def __init__(self):
+        self.message_parser = self
+        self.called = []
+
+    def validate_token(self, token):
+        return True
+
+    def lookup_message_service(self, category, name):
+        return name
+
+    def call_message_service(self, service, event, header):
+        if service == 'broken':
+            raise Exception("Service failed")
+        self.called.append(event.params)
+
+
+class Header(object):
+    content_type = BATCH_CONTENT_TYPE
+    headers = None
+
+
+class BatchDispatchTest(unittest.TestCase):
+    def test_bad_event_does_not_drop_others(self):
+        codec = get_codec('binary')
+        body = encode_batch([
+            codec.encode(CONFIG, 'test', 'ok', {'i': 1}),
+            b'not an event',
+            codec.encode(CONFIG, 'test', 'broken', {'i': 2}),
+            codec.encode(CONFIG, 'test', 'ok', {'i': 3}),
+        ])
+        dispatcher = Dispatcher()
+        dispatcher.dispatch_message(Header(), body)
+        self.assertEqual(dispatcher.called, [{'i': 1}, {'i': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import time
+import threading
+import unittest
+from servicebus.cache import ResponseCache, SingleFlight
+from servicebus.configuration import Configuration
+from servicebus.dispatch import TOKEN_ERROR, NO_SERVICE_ERROR
+from servicebus.message import TimeoutException
+from servicebus.sender import Sender
+
+CONFIG = Configuration({
+    'hosts': ['127.0.0.1'],
+    'user': 'guest',
+    'password': 'guest',
+    'node_name': 'TESTER-001',
+    'secret_token': 'secret token',
+})
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_no_ttl_is_not_cached(self):
+        cache = ResponseCache()
+        cache.put('NODE.math.add', {'a': 1}, 'result')
+        self.assertEqual(cache.get('NODE.math.add', {'a': 1}), (False, None))
+
+    def test_params_key_order(self):
+        cache = ResponseCache(default_ttl=60)
+        cache.put('NODE.math.add', {'a': 1, 'b': 2}, 'result')
+        self.assertEqual(cache.get('NODE.math.add', {'b': 2, 'a': 1}), (True, 'result'))
+        self.assertEqual(cache.get('NODE.math.add', {'a': 2, 'b': 2}), (False, None))
+        self.assertEqual(cache.get('OTHER.math.add', {'a': 1, 'b': 2}), (False, None))
+
+    def test_ttl_lookup(self):
+        cache = ResponseCache(default_ttl=30)
+        cache.set_ttl('math.add', 10)
+        cache.set_ttl('NODE.math.add', 20)
+        cache.set_ttl('NODE.math.sub', 0)
+        self.assertEqual(cache.get_ttl('NODE.math.add'), 20)
+        self.assertEqual(cache.get_ttl('OTHER.math.add'), 10)
+        self.assertEqual(cache.get_ttl('NODE.math.mul'), 30)
+        # TTL of full target wins over default_ttl, even if it disables cache.
+        self.assertEqual(cache.get_ttl('NODE.math.sub'), 0)
+        cache.put('NODE.math.sub', {}, 'result')
+        self.assertEqual(cache.get('NODE.math.sub', {}), (False, None))
+
+    def test_expire(self):
+        cache = ResponseCache()
+        cache.set_ttl('math.add', 0.05)
+        cache.put('NODE.math.add', {}, 'result')
+        self.assertEqual(cache.get('NODE.math.add', {}), (True, 'result'))
+        time.sleep(0.1)
+        self.assertEqual(cache.get('NODE.math.add', {}), (False, None))
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_size=2, default_ttl=60)
+        cache.put('NODE.math.add', {'a': 1}, 1)
+        cache.put('NODE.math.add', {'a': 2}, 2)
+        # Using first entry makes second one least recently used.
+        self.assertEqual(cache.get('NODE.math.add', {'a': 1}), (True, 1))
+        cache.put('NODE.math.add', {'a': 3}, 3)
+        self.assertEqual(cache.get('NODE.math.add', {'a': 2}), (False, None))
+        self.assertEqual(cache.get('NODE.math.add', {'a': 1}), (True, 1))
+        self.assertEqual(cache.get('NODE.math.add', {'a': 3}), (True, 3))
+        self.assertEqual(len(cache.entries), 2)
+
+    def test_invalidate(self):
+        cache = ResponseCache(default_ttl=60)
+        for target in ('NODE.math.add', 'NODE.math.sub'):
+            for a in (1, 2):
+                cache.put(target, {'a': a}, a)
+        cache.invalidate('NODE.math.add', {'a': 1})
+        self.assertEqual(cache.get('NODE.math.add', {'a': 1}), (False, None))
+        self.assertEqual(cache.get('NODE.math.add', {'a': 2}), (True, 2))
+        cache.invalidate('NODE.math.add')
+        self.assertEqual(cache.get('NODE.math.add', {'a': 2}), (False, None))
+        self.assertEqual(cache.get('NODE.math.sub', {'a': 1}), (True, 1))
+        cache.invalidate()
+        self.assertEqual(len(cache.entries), 0)
+
+
+class CachedSenderTest(unittest.TestCase):
+    def make_sender(self, response):
+        sender = Sender(CONFIG)
+        sender.set_response_cache(ResponseCache(default_ttl=60))
+        calls = []
+
+        def do_call(target, params, timeout, reverse):
+            calls.append(target)
+            return response
+        sender.do_call = do_call
+        return sender, calls
+
+    def test_response_is_cached(self):
+        sender, calls = self.make_sender(('1', 'result'))
+        self.assertEqual(sender.call('NODE.math.add', {'a': 1}), ('1', 'result'))
+        self.assertEqual(sender.call('NODE.math.add', {'a': 1}), ('1', 'result'))
+        self.assertEqual(len(calls), 1)
+
+    def test_error_reply_is_not_cached(self):
+        for message in (TOKEN_ERROR, NO_SERVICE_ERROR + 'math.add'):
+            sender, calls = self.make_sender(('1', message))
+            sender.call('NODE.math.add', {'a': 1})
+            sender.call('NODE.math.add', {'a': 1})
+            self.assertEqual(len(calls), 2, message)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def start_leader(self, single_flight, func, *args):
+        # Run func as leader of key in a thread, return when it started.
+        started = threading.Event()
+        results = []
+
+        def lead():
+            started.set()
+            return func(*args)
+
+        def run():
+            try:
+                results.append(single_flight.do('key', 5, lead))
+            except Exception as e:
+                results.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        started.wait()
+        return thread, results
+
+    def test_followers_share_result(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def leader():
+            calls.append(1)
+            release.wait()
+            return 'result'
+
+        thread, results = self.start_leader(single_flight, leader)
+        followers = []
+        threads = []
+        for i in range(3):
+            t = threading.Thread(target=lambda: followers.append(single_flight.do('key', 5, leader)))
+            t.start()
+            threads.append(t)
+        time.sleep(0.05)
+        release.set()
+        for t in threads + [thread]:
+            t.join()
+        self.assertEqual(results, ['result'])
+        self.assertEqual(followers, ['result'] * 3)
+        self.assertEqual(calls, [1])
+        # Key is free again once the flight finished.
+        self.assertEqual(single_flight.do('key', 5, lambda: 'next'), 'next')
+
+    def test_followers_share_exception(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        error = Exception("Call failed")
+
+        def leader():
+            release.wait()
+            raise error
+
+        thread, results = self.start_leader(single_flight, leader)
+        followers = []
+
+        def follow():
+            try:
+                single_flight.do('key', 5, leader)
+            except Exception as e:
+                followers.append(e)
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        follower.join()
+        thread.join()
+        self.assertEqual(results, [error])
+        self.assertEqual(followers, [error])
+
+    def test_follower_timeout(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        thread, results = self.start_leader(single_flight, release.wait)
+        start = time.time()
+        self.assertRaises(TimeoutException, single_flight.do, 'key', 0.1, release.wait)
+        self.assertTrue(time.time() - start < 1)
+        # Leader is not affected by follower's timeout.
+        release.set()
+        thread.join()
+        self.assertEqual(results, [True])
+
+    def test_different_keys_do_not_wait(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        thread, results = self.start_leader(single_flight, release.wait)
+        self.assertEqual(single_flight.do('other', 0.1, lambda: 'other'), 'other')
+        release.set()
+        thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
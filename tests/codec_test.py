@@ -0,0 +1,132 @@
+import json
+import struct
+import unittest
+from servicebus.pika import spec
+from servicebus.configuration import Configuration
+from servicebus.message import MessageSender, Envelope, decompress_body
+from servicebus.codec import get_codec, decode_event, encode_params, CATEGORY_HEADER
+
+CONFIG = Configuration({
+    'hosts': ['127.0.0.1'],
+    'user': 'guest',
+    'password': 'guest',
+    'node_name': 'TESTER-001',
+    'secret_token': 'secret token',
+})
+CODECS = ('xml', 'json', 'binary', 'headers')
+PARAMS = {'a': 1, 'b': [1.5, None, True], 'text': u'\xe9 < & ]]> \u4e2d'}
+
+
+def wire(body, properties):
+    # What a receiver gets: AMQP encoded properties and bytes body.
+    decoded = spec.BasicProperties()
+    decoded.decode(b''.join(properties.encode()))
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    return body, decoded
+
+
+def build_message(codec, params, compress_threshold=None):
+    sender = MessageSender('127.0.0.1', 5672, 'guest', 'guest')
+    sender.set_content_type(codec.content_type)
+    sender.set_compression('zlib', compress_threshold)
+    body, properties = sender.build_message(codec.encode(CONFIG, 'math', 'add', params), 30)
+    return wire(body, properties)
+
+
+def receive(body, properties):
+    return decode_event(decompress_body(body, properties), properties)
+
+
+class CodecTest(unittest.TestCase):
+    def assertEvent(self, event, params):
+        self.assertNotEqual(event, None)
+        self.assertEqual(event.category, 'math')
+        self.assertEqual(event.service, 'add')
+        self.assertEqual(event.version, '1')
+        self.assertTrue(CONFIG.token_cache.validate(event.token))
+        self.assertEqual(event.params, params)
+
+    def test_round_trip(self):
+        for name in CODECS:
+            codec = get_codec(name)
+            body, properties = build_message(codec, PARAMS)
+            self.assertEqual(properties.content_type, codec.content_type, name)
+            self.assertEvent(receive(body, properties), PARAMS)
+
+    def test_compressed_round_trip(self):
+        for name in CODECS:
+            body, properties = build_message(get_codec(name), PARAMS, 0)
+            self.assertEqual(properties.content_encoding, 'zlib')
+            self.assertEvent(receive(body, properties), PARAMS)
+
+    def test_event_ids_are_unique(self):
+        for name in CODECS:
+            codec = get_codec(name)
+            first = receive(*build_message(codec, {}))
+            second = receive(*build_message(codec, {}))
+            self.assertNotEqual(first.id, second.id)
+
+    def test_headers_codec_properties(self):
+        body, properties = build_message(get_codec('headers'), PARAMS)
+        self.assertEqual(properties.headers[CATEGORY_HEADER], 'math')
+        self.assertNotEqual(properties.message_id, None)
+        self.assertEqual(json.loads(body.decode('utf-8')), PARAMS)
+        # Deadline set by build_message is kept with codec's headers.
+        self.assertTrue('x-deadline' in properties.headers)
+
+    def test_headers_codec_missing_header(self):
+        body, properties = build_message(get_codec('headers'), PARAMS)
+        del properties.headers[CATEGORY_HEADER]
+        self.assertEqual(receive(body, properties), None)
+
+    def test_binary_truncated_and_oversized(self):
+        body, properties = build_message(get_codec('binary'), PARAMS)
+        for size in (0, 1, 3, len(body) // 2, len(body) - 1):
+            self.assertEqual(receive(body[:size], properties), None, size)
+        self.assertEqual(receive(body + b'x', properties), None)
+        # Params length larger than body.
+        start = len(body) - len(encode_params(PARAMS))
+        oversized = body[:start - 4] + struct.pack('>I', 1 << 30) + body[start:]
+        self.assertEqual(receive(oversized, properties), None)
+
+    def test_json_broken(self):
+        body, properties = build_message(get_codec('json'), PARAMS)
+        self.assertEqual(receive(body[:-1], properties), None)
+        self.assertEqual(receive(b'{"id": "1"}', properties), None)
+
+    def test_unknown_content_type(self):
+        body, properties = build_message(get_codec('json'), PARAMS)
+        properties.content_type = 'application/x-unknown'
+        self.assertRaises(Exception, receive, body, properties)
+
+    def test_known_aliases(self):
+        xml_body, properties = build_message(get_codec('xml'), PARAMS)
+        json_body = build_message(get_codec('json'), PARAMS)[0]
+        for content_type, body in (('text/xml', xml_body), ('application/json', json_body)):
+            properties.content_type = content_type
+            self.assertEvent(receive(body, properties), PARAMS)
+
+    def test_raw_params_pass_through(self):
+        event = receive(*build_message(get_codec('binary'), PARAMS))
+        raw = event.get_raw_params()
+        self.assertTrue(isinstance(raw, memoryview))
+        for name in CODECS:
+            forwarded = receive(*build_message(get_codec(name), raw))
+            self.assertEvent(forwarded, PARAMS)
+        # Forwarding did not decode params of the original event.
+        self.assertFalse(event.params_decoded)
+
+    def test_envelope_properties(self):
+        sender = MessageSender('127.0.0.1', 5672, 'guest', 'guest')
+        msg = Envelope(b'body', content_type='application/json', headers={'x-a': '1'})
+        body, properties = sender.build_message(msg, 30, reply_to='queue')
+        self.assertEqual(body, b'body')
+        self.assertEqual(properties.content_type, 'application/json')
+        self.assertEqual(properties.reply_to, 'queue')
+        self.assertEqual(properties.headers['x-a'], '1')
+        self.assertTrue('x-deadline' in properties.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import json
+import unittest
+from xml.dom.minidom import parseString
+from servicebus.parser import XmlMessageParser, XmlResponseParser, XmlRequestGenerator, XmlResponseGenerator
+from servicebus.parser import TokenCache
+
+
+# Reference parsers: the minidom implementation replaced by XmlScanner.
+def get_text(node):
+    rc = []
+    for child in node.childNodes:
+        if child.nodeType == node.TEXT_NODE or child.nodeType == node.CDATA_SECTION_NODE:
+            rc.append(child.data)
+    return ''.join(rc)
+
+
+def minidom_parse_event(xml_doc):
+    try:
+        root = parseString(xml_doc).childNodes[0]
+        if root.tagName != 'event' or not root.hasAttribute('version'):
+            return None
+        fields = [get_text(root.getElementsByTagName(name)[0]) for name in ('id', 'catgory', 'service', 'token')]
+        params = json.loads(get_text(root.getElementsByTagName('params')[0]))
+        return tuple(fields) + (params, root.getAttribute('version'))
+    except Exception:
+        return None
+
+
+def minidom_parse_response(xml_doc):
+    try:
+        root = parseString(xml_doc).childNodes[0]
+        return (get_text(root.getElementsByTagName('id')[0]), get_text(root.getElementsByTagName('message')[0]))
+    except Exception:
+        return None
+
+
+def event_tuple(event):
+    if event is None:
+        return None
+    return (event.id, event.category, event.service, event.token, event.params, event.version)
+
+
+EVENT_TEMPLATE = """<?xml version="1.0"?>
+<event version="%s">
+    <id>%s</id>
+    <token>%s</token>
+    <catgory>%s</catgory>
+    <service>%s</service>
+    <params>%s</params>
+</event>
+"""
+
+EVENTS = [
+    # params in CDATA
+    EVENT_TEMPLATE % ('1', '1', 'abc', 'math', 'add', '<![CDATA[{"a": 1, "b": [1, 2]}]]>'),
+    # params as text with entities, CDATA with markup inside
+    EVENT_TEMPLATE % ('1', '2', 'abc', 'math', 'add', '{&quot;a&quot;: &quot;x &amp; y &lt;z&gt;&quot;}'),
+    EVENT_TEMPLATE % ('1', '3', 'abc', 'math', 'add', '<![CDATA[{"xml": "<a>&amp;</a>"}]]>'),
+    # params split in text and CDATA, surrounded by whitespace
+    EVENT_TEMPLATE % ('1', '4', 'abc', 'math', 'add', '\n    {"a": <![CDATA["b"]]>}\n    '),
+    # entities in fields and a non ASCII character reference
+    EVENT_TEMPLATE % ('2', '5&amp;6', 't&lt;k', 'c&#233;t', 's&gt;v', '{}'),
+    # empty params object and list, null params
+    EVENT_TEMPLATE % ('1', '7', 'abc', 'math', 'add', '<![CDATA[{}]]>'),
+    EVENT_TEMPLATE % ('1', '8', 'abc', 'math', 'add', '[]'),
+    EVENT_TEMPLATE % ('1', '9', 'abc', 'math', 'add', 'null'),
+    # no params
+    EVENT_TEMPLATE % ('1', '10', 'abc', 'math', 'add', ''),
+    EVENT_TEMPLATE % ('1', '11', 'abc', 'math', 'add', '<![CDATA[]]>'),
+    EVENT_TEMPLATE.replace('<params>%s</params>', '<params/>') % ('1', '12', 'abc', 'math', 'add'),
+    # not an event, no version, missing field, broken XML
+    EVENT_TEMPLATE.replace('event', 'request') % ('1', '13', 'abc', 'math', 'add', '{}'),
+    EVENT_TEMPLATE.replace(' version="%s"', '') % ('14', 'abc', 'math', 'add', '{}'),
+    EVENT_TEMPLATE.replace('<token>%s</token>', '') % ('1', '15', 'math', 'add', '{}'),
+    EVENT_TEMPLATE[:-10] % ('1', '16', 'abc', 'math', 'add', '{}'),
+]
+
+RESPONSES = [
+    XmlResponseGenerator(1, '{"ret": 3}').to_xml(),
+    XmlResponseGenerator(2, 'a < b & c').to_xml(),
+    XmlResponseGenerator(3, '').to_xml(),
+    '<?xml version="1.0"?><response><id>4</id><message>x &amp; &lt;y&gt; <![CDATA[&z]]></message></response>',
+    '<?xml version="1.0"?><response><id>5</id><message/></response>',
+    '<?xml version="1.0"?><response><id>6</id></response>',
+    '<?xml version="1.0"?><response><id>7</id><message>',
+]
+
+
+class Config(object):
+    secret_token = 'secret token'
+    token_cache = TokenCache(secret_token)
+
+
+class ParserTest(unittest.TestCase):
+    def test_events_same_as_minidom(self):
+        parser = XmlMessageParser()
+        for xml_doc in EVENTS:
+            for doc in (xml_doc, xml_doc.encode('utf-8')):
+                self.assertEqual(event_tuple(parser.parse(doc)), minidom_parse_event(doc), xml_doc)
+
+    def test_responses_same_as_minidom(self):
+        parser = XmlResponseParser()
+        for xml_doc in RESPONSES:
+            for doc in (xml_doc, xml_doc.encode('utf-8')):
+                self.assertEqual(parser.parse(doc), minidom_parse_response(doc), xml_doc)
+
+    def test_generated_event(self):
+        params = {'text': 'a < b & c ]]', 'list': [1, 2.5, None], 'unicode': u'\u4e2d'}
+        xml_doc = XmlRequestGenerator(Config(), 'math', 'add', params).to_xml()
+        event = XmlMessageParser().parse(xml_doc)
+        self.assertEqual(event_tuple(event), minidom_parse_event(xml_doc))
+        self.assertEqual(event.params, params)
+
+    def test_raw_params_forwarded(self):
+        params = {'a': [1, 2], 'b': u'\xe9 & <x>'}
+        xml_doc = XmlRequestGenerator(Config(), 'math', 'add', params).to_xml()
+        event = XmlMessageParser().parse(xml_doc)
+        raw = event.get_raw_params()
+        self.assertTrue(isinstance(raw, memoryview))
+        self.assertEqual(json.loads(raw.tobytes().decode('utf-8')), params)
+        # Raw params are sent again without decoding.
+        forwarded = XmlRequestGenerator(Config(), 'math', 'sub', raw).to_xml()
+        self.assertFalse(event.params_decoded)
+        self.assertEqual(minidom_parse_event(forwarded)[4], params)
+        self.assertEqual(XmlMessageParser().parse(forwarded).params, params)
+
+    def test_broken_params_fail_on_access(self):
+        # Params are decoded lazily, minidom parser rejected the event.
+        xml_doc = EVENT_TEMPLATE % ('1', '1', 'abc', 'math', 'add', '{"a": ')
+        self.assertEqual(minidom_parse_event(xml_doc), None)
+        event = XmlMessageParser().parse(xml_doc)
+        self.assertEqual(event.id, '1')
+        self.assertRaises(ValueError, lambda: event.params)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,7 @@ CONFIG = Configuration({
     'password': '123456',
     'use_ssl': False,
     'node_name': 'TESTER-001',
+    'keep_alive': True,
     'secret_token': 'secret token',
 })
 
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from servicebus.message import Envelope
+from servicebus.spool import Spool, read_records, lock_file, fcntl, RECORD_HEADER, OFFSET_SUFFIX
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def write_segment(self, messages):
+        for target, msg in messages:
+            self.spool.append(target, msg)
+        self.spool.close()
+        return self.spool.segments()[0]
+
+    def read_segment(self, path):
+        with open(path, 'rb') as fp:
+            return [(target, msg) for end, target, msg in read_records(fp)]
+
+    def test_round_trip(self):
+        envelope = Envelope(b'{"a":1}', content_type='application/json', headers={'x-id': '1'})
+        path = self.write_segment([('node1', b'first'), ('node2', 'second'), ('node1', envelope)])
+        records = self.read_segment(path)
+        self.assertEqual(records[0], ('node1', b'first'))
+        self.assertEqual(records[1], ('node2', b'second'))
+        self.assertEqual(records[2][0], 'node1')
+        self.assertEqual(records[2][1].body, b'{"a":1}')
+        self.assertEqual(records[2][1].properties, envelope.properties)
+
+    def test_crc_mismatch_stops_reading(self):
+        path = self.write_segment([('node1', b'first'), ('node1', b'second'), ('node1', b'third')])
+        first_size = RECORD_HEADER.size + len(b'node1\0\0first')
+        with open(path, 'r+b') as fp:
+            # Flip last byte of second record's body.
+            fp.seek(first_size + RECORD_HEADER.size + len(b'node1\0\0second') - 1)
+            byte = fp.read(1)
+            fp.seek(-1, os.SEEK_CUR)
+            fp.write(bytes(bytearray([ord(byte) ^ 0xff])))
+        self.assertEqual(self.read_segment(path), [('node1', b'first')])
+
+    def test_torn_tail_is_ignored(self):
+        path = self.write_segment([('node1', b'first'), ('node1', b'second')])
+        size = os.path.getsize(path)
+        for cut in (1, len(b'second'), RECORD_HEADER.size + 2):
+            with open(path, 'r+b') as fp:
+                fp.truncate(size - cut)
+            self.assertEqual(self.read_segment(path), [('node1', b'first')])
+            size = size - cut
+
+    def test_drain_resumes_from_offset(self):
+        path = self.write_segment([('node1', b'm%d' % i) for i in range(5)])
+        sent = []
+
+        def fail_third(messages):
+            results = []
+            for target, msg in messages:
+                ok = len(sent) < 2
+                if ok:
+                    sent.append(msg)
+                results.append(ok)
+            return results
+
+        self.assertEqual(self.spool.drain(fail_third), 2)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + OFFSET_SUFFIX))
+
+        def send_all(messages):
+            sent.extend(msg for target, msg in messages)
+            return [True] * len(messages)
+
+        self.assertEqual(self.spool.drain(send_all), 3)
+        self.assertEqual(sent, [b'm0', b'm1', b'm2', b'm3', b'm4'])
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + OFFSET_SUFFIX))
+        self.assertFalse(self.spool.has_records())
+
+    @unittest.skipIf(fcntl is None, "flock is not available")
+    def test_drain_skips_locked_segment(self):
+        path = self.write_segment([('node1', b'first')])
+        sent = []
+
+        def send_all(messages):
+            sent.extend(msg for target, msg in messages)
+            return [True] * len(messages)
+
+        # Same as active segment of another process.
+        with open(path, 'ab') as fp:
+            self.assertTrue(lock_file(fp))
+            self.assertEqual(self.spool.drain(send_all), 0)
+            self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.spool.drain(send_all), 1)
+        self.assertEqual(sent, [b'first'])
+
+    def test_send_error_keeps_segment(self):
+        path = self.write_segment([('node1', b'first')])
+
+        def broken(messages):
+            raise Exception("Cannot Connect to Message Queue!")
+
+        self.assertEqual(self.spool.drain(broken), 0)
+        self.assertEqual(self.read_segment(path), [('node1', b'first')])
+
+
+if __name__ == '__main__':
+    unittest.main()